@@ -1,24 +1,141 @@
 """
 settings
     chat_id             - Unique user identifier
-    key                 - Specific setting key (string)
-    value               - Value for the setting key (string)
-    - model
-    - prompt
-    - temperature
-    - max_tokens
-    - max_history_tokens
+    key                 - Specific setting key (string), one of y_GPT.SETTINGS (model, prompt, ...)
+    value               - Value for the setting key (string), parsed by y_GPT
 current_chats
     chat_id             - Unique user identifier
-    chat_history        - Whole conversation history, in a single JSON
-saved_chats
+    chat_history        - Legacy whole-history JSON, migrated into messages by init_db()
+    session_id          - The chat's current session (NULL until it needs one)
+sessions                - Every conversation of a chat: the current one and the saved ones
+    session_id          - Unique conversation identifier
     chat_id             - Unique user identifier
-    chat_name           - Name under which the chat history is saved (string)
-    chat_history        - Whole conversation history, saved under chat_name
+    name                - Name the conversation is saved under, NULL for the current one
+messages
+    message_id          - Unique message identifier, rowid of messages_fts
+    session_id          - Conversation the message belongs to
+    seq                 - Position of the message in the conversation
+    role                - system / user / assistant
+    content             - Message text, long ones compressed (see text_encode)
+    token_count         - Cached token count of the message (NULL if not counted yet)
+messages_text           - View of user and assistant messages as plain text, the content table of messages_fts
+    id                  - message_id
+    chat_id             - The chat_id as one token (see _fts_chat), so a search only walks that user's messages
+    content             - Message text
+messages_fts            - FTS5 index of messages_text, rowid = id. Stores no text of its own
+session_names           - View of the saved sessions, the content table of session_names_fts
+    id                  - session_id
+    chat_id             - Same token as in messages_text
+    name                - Name of the session
+session_names_fts       - FTS5 index of session_names, rowid = id
+cache
+    namespace           - What is cached (e.g. transcripts)
+    key                 - Cache key within the namespace
+    value               - zlib-compressed UTF-8 text
+    size                - len(value), for the size limit
+    created_at          - Unix time, for TTL
+    accessed_at         - Unix time, for LRU eviction
 """
 
 import sqlite3
+import threading
 import json
+import re
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+DB_PATH = 'y_userdata.db'
+
+## One long-lived connection per process instead of connect()/close() per call.
+## isolation_level=None means we BEGIN/COMMIT ourselves, so every function below
+## is exactly one transaction (one fsync) no matter how many statements it runs.
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",      # Safe with WAL, skips the fsync on every commit
+    "PRAGMA cache_size=-16000",       # ~16MB page cache
+    "PRAGMA mmap_size=268435456",     # 256MB
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+DB_CACHED_STATEMENTS = 128
+
+## Per-chat settings, LRU-bounded. Filled with one query per chat, kept in sync by key_set/key_remove
+SETTINGS_CACHE_SIZE = 1024
+
+## Format of stored texts, see text_encode
+TEXT_FORMAT_PLAIN = 0       # Bare TEXT, no header byte
+TEXT_FORMAT_ZLIB = 1        # Header byte + zlib-compressed UTF-8
+TEXT_FORMAT = TEXT_FORMAT_ZLIB
+TEXT_COMPRESS_MIN = 1024    # Shorter texts barely shrink, they're always stored plain
+TEXT_COMPRESS_LEVEL = 6
+
+## chat_search
+SEARCH_RESULTS = 10
+SNIPPET_TOKENS = 12
+NAME_WEIGHT = 10            # A word in the name counts as much as ten in a message
+
+_conn = None
+_lock = threading.RLock()
+_settings_cache = OrderedDict()
+_cache_stats = {}  # namespace: [hits, misses], since process start
+
+
+################
+## CONNECTION ##
+################
+
+
+def get_connection():
+    global _conn
+    if _conn is None:
+        with _lock:
+            if _conn is None:
+                conn = sqlite3.connect(
+                    DB_PATH,
+                    isolation_level=None,
+                    check_same_thread=False,
+                    cached_statements=DB_CACHED_STATEMENTS
+                )
+                for pragma in DB_PRAGMAS:
+                    conn.execute(pragma)
+                conn.create_function("text_encode", 1, text_encode)
+                conn.create_function("text_decode", 1, text_decode, deterministic=True)
+                _conn = conn
+    return _conn
+
+
+def close_connection():
+    global _conn
+    with _lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
+
+
+@contextmanager
+def transaction():
+    with _lock:
+        conn = get_connection()
+        if conn.in_transaction:
+            # Nested call (e.g. chat_save -> history_get), join the outer transaction
+            yield conn.cursor()
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn.cursor()
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+@contextmanager
+def reading():
+    with _lock:
+        yield get_connection().cursor()
+
 
 ##########
 ## INIT ##
@@ -26,24 +143,114 @@ import json
 
 
 def init_db():
-    conn = sqlite3.connect('y_userdata.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS settings
-                (chat_id INTEGER, key TEXT, value TEXT, PRIMARY KEY (chat_id, key))''')
-    c.execute('''CREATE TABLE IF NOT EXISTS current_chats
-                (chat_id INTEGER PRIMARY KEY, chat_history TEXT DEFAULT '[]')''')
-    c.execute('''CREATE TABLE IF NOT EXISTS saved_chats
-                (chat_id INTEGER, chat_name TEXT, chat_history TEXT, PRIMARY KEY (chat_id, chat_name))''')
-    conn.commit()
-    conn.close()
+    with transaction() as c:
+        migrate_sessions_schema(c)
+        c.execute('''CREATE TABLE IF NOT EXISTS settings
+                    (chat_id INTEGER, key TEXT, value TEXT, PRIMARY KEY (chat_id, key))''')
+        c.execute('''CREATE TABLE IF NOT EXISTS current_chats
+                    (chat_id INTEGER PRIMARY KEY, chat_history TEXT DEFAULT '[]', session_id INTEGER)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS sessions
+                    (session_id INTEGER PRIMARY KEY, chat_id INTEGER, name TEXT, UNIQUE (chat_id, name))''')
+        c.execute('''CREATE TABLE IF NOT EXISTS messages
+                    (message_id INTEGER PRIMARY KEY, session_id INTEGER, seq INTEGER, role TEXT, content TEXT,
+                     token_count INTEGER, UNIQUE (session_id, seq))''')
+        c.execute('''CREATE TABLE IF NOT EXISTS cache
+                    (namespace TEXT, key TEXT, value BLOB, size INTEGER, created_at REAL, accessed_at REAL,
+                     PRIMARY KEY (namespace, key))''')
+        c.execute("CREATE INDEX IF NOT EXISTS cache_lru ON cache(namespace, accessed_at)")
+        c.execute('''CREATE VIEW IF NOT EXISTS messages_text AS
+                     SELECT message_id AS id, 'c' || replace(chat_id, '-', 'n') AS chat_id, text_decode(content) AS content
+                     FROM messages JOIN sessions USING (session_id) WHERE role != 'system' ''')
+        c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+                    USING fts5(chat_id, content, content='messages_text', content_rowid='id')''')
+        c.execute('''CREATE VIEW IF NOT EXISTS session_names AS
+                     SELECT session_id AS id, 'c' || replace(chat_id, '-', 'n') AS chat_id, name
+                     FROM sessions WHERE name IS NOT NULL''')
+        c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS session_names_fts
+                    USING fts5(chat_id, name, content='session_names', content_rowid='id')''')
+        migrate_sessions(c)
+        migrate_history_blobs(c)
+
+
+## Older versions kept the messages of one conversation per chat_id, saved chats as whole
+## histories in saved_chats, and an index over those. Gets the old tables out of the way
+def migrate_sessions_schema(c):
+    c.execute("SELECT name FROM pragma_table_info('current_chats')")
+    columns = {row[0] for row in c.fetchall()}
+    if columns and "session_id" not in columns:
+        c.execute("ALTER TABLE current_chats ADD COLUMN session_id INTEGER")
+    c.execute("DROP TABLE IF EXISTS saved_chats_fts")
+    c.execute("DROP VIEW IF EXISTS saved_chats_text")
+    c.execute("SELECT 1 FROM pragma_table_info('messages') WHERE name='chat_id'")
+    if c.fetchone() is not None:
+        c.execute("ALTER TABLE messages RENAME TO messages_by_chat")
+
+
+## ...and moves their contents in: every chat's messages become its current session,
+## every saved chat a named one
+def migrate_sessions(c):
+    c.execute("SELECT 1 FROM sqlite_master WHERE name='messages_by_chat'")
+    if c.fetchone() is not None:
+        c.execute("SELECT DISTINCT chat_id FROM messages_by_chat")
+        for (chat_id,) in c.fetchall():
+            session_id = _current_session(c, chat_id)
+            c.execute('''INSERT INTO messages(session_id, seq, role, content, token_count)
+                         SELECT ?, seq, role, text_encode(content), token_count FROM messages_by_chat
+                         WHERE chat_id=?''', (session_id, chat_id))
+            _fts_add_messages(c, "session_id=?", (session_id,))
+        c.execute("DROP TABLE messages_by_chat")
+
+    c.execute("SELECT 1 FROM sqlite_master WHERE name='saved_chats'")
+    if c.fetchone() is not None:
+        c.execute("SELECT chat_id, chat_name, chat_history FROM saved_chats")
+        for chat_id, chat_name, chat_history in c.fetchall():
+            c.execute("INSERT INTO sessions(chat_id, name) VALUES(?, ?)", (chat_id, chat_name))
+            session_id = c.lastrowid
+            _fts_add_name(c, session_id)
+            _messages_from_json(c, session_id, text_decode(chat_history))
+        c.execute("DROP TABLE saved_chats")
+
+
+## Older versions kept the whole current conversation as one JSON blob in current_chats
+def migrate_history_blobs(c):
+    c.execute("SELECT chat_id, chat_history FROM current_chats WHERE chat_history != '[]'")
+    for chat_id, chat_history in c.fetchall():
+        session_id = _current_session(c, chat_id)
+        _delete_messages(c, "session_id=?", (session_id,))
+        _messages_from_json(c, session_id, chat_history)
+        c.execute("UPDATE current_chats SET chat_history='[]' WHERE chat_id=?", (chat_id,))
+
+
+## Compresses long messages stored plain (by older versions), then VACUUMs to give the space back.
+## One-shot and slow on a big DB (every other DB call waits), for the owner's /db_migrate.
+## Returns (messages compressed, DB bytes before, DB bytes after)
+def compress_messages():
+    size_before = _db_size()
+    with transaction() as c:
+        c.execute("SELECT message_id, content FROM messages WHERE typeof(content)='text' AND length(content) >= ?",
+                  (TEXT_COMPRESS_MIN,))
+        compressed = []
+        for message_id, content in c.fetchall():
+            encoded = text_encode(content)
+            if isinstance(encoded, bytes):
+                compressed.append((encoded, message_id))
+        # Same text, so messages_fts stays as it is
+        c.executemany("UPDATE messages SET content=? WHERE message_id=?", compressed)
+    with _lock:
+        get_connection().execute("VACUUM")
+        get_connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return len(compressed), size_before, _db_size()
+
+
+def _db_size():
+    with reading() as c:
+        c.execute("SELECT page_count * page_size FROM pragma_page_count(), pragma_page_size()")
+        return c.fetchone()[0]
 
 
 def init_user(chat_id):
-    conn = sqlite3.connect('y_userdata.db')
-    c = conn.cursor()
-    c.execute("INSERT OR IGNORE INTO current_chats(chat_id) VALUES(?)", (chat_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as c:
+        c.execute("INSERT OR IGNORE INTO current_chats(chat_id) VALUES(?)", (chat_id,))
 
 
 ##############
@@ -51,29 +258,39 @@ def init_user(chat_id):
 ##############
 
 
+## All of the chat's settings as {key: value}. The dict is shared with the cache, don't modify it
+def settings_get(chat_id):
+    with reading() as c:
+        settings = _settings_cache.get(chat_id)
+        if settings is None:
+            c.execute("SELECT key, value FROM settings WHERE chat_id=?", (chat_id,))
+            settings = dict(c.fetchall())
+            _settings_cache[chat_id] = settings
+            if len(_settings_cache) > SETTINGS_CACHE_SIZE:
+                _settings_cache.popitem(last=False)
+        else:
+            _settings_cache.move_to_end(chat_id)
+    return settings
+
+
 def key_get(chat_id, key):
-    conn = sqlite3.connect('y_userdata.db')
-    c = conn.cursor()
-    c.execute("SELECT value FROM settings WHERE chat_id=? AND key=?", (chat_id, key))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else None
+    return settings_get(chat_id).get(key)
 
 
 def key_set(chat_id, key, value):
-    conn = sqlite3.connect('y_userdata.db')
-    c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO settings(chat_id, key, value) VALUES(?, ?, ?)", (chat_id, key, value))
-    conn.commit()
-    conn.close()
+    with transaction() as c:
+        c.execute("INSERT OR REPLACE INTO settings(chat_id, key, value) VALUES(?, ?, ?)", (chat_id, key, value))
+        if chat_id in _settings_cache:
+            _settings_cache[chat_id] = {**_settings_cache[chat_id], key: value}
 
 
 def key_remove(chat_id, key):
-    conn = sqlite3.connect('y_userdata.db')
-    c = conn.cursor()
-    c.execute("DELETE FROM settings WHERE chat_id=? AND key=?", (chat_id, key))
-    conn.commit()
-    conn.close()
+    with transaction() as c:
+        c.execute("DELETE FROM settings WHERE chat_id=? AND key=?", (chat_id, key))
+        if chat_id in _settings_cache:
+            settings = dict(_settings_cache[chat_id])
+            settings.pop(key, None)
+            _settings_cache[chat_id] = settings
 
 
 #############
@@ -81,101 +298,366 @@ def key_remove(chat_id, key):
 #############
 
 
+## Texts are stored as one header byte with the format version, then the payload. Plain text
+## has no header, it's stored as TEXT (SQLite keeps the type), and so is anything shorter than
+## TEXT_COMPRESS_MIN. Older versions stored whole saved histories this way
+def text_encode(text, version=None):
+    version = TEXT_FORMAT if version is None else version
+    if version == TEXT_FORMAT_PLAIN or not isinstance(text, str) or len(text) < TEXT_COMPRESS_MIN:
+        return text
+    if version == TEXT_FORMAT_ZLIB:
+        return bytes([version]) + zlib.compress(text.encode('utf-8'), TEXT_COMPRESS_LEVEL)
+    raise ValueError(f"Unknown text format {version}")
+
+
+def text_decode(value):
+    if not isinstance(value, bytes):
+        return value
+    if value[0] == TEXT_FORMAT_ZLIB:
+        return zlib.decompress(memoryview(value)[1:]).decode('utf-8')
+    raise ValueError(f"Unknown text format {value[0]}")
+
+
+## The chat's current session, a new empty one if it has none yet
+def _current_session(c, chat_id):
+    c.execute("SELECT session_id FROM current_chats WHERE chat_id=?", (chat_id,))
+    result = c.fetchone()
+    if result is not None and result[0] is not None:
+        return result[0]
+    c.execute("INSERT INTO sessions(chat_id) VALUES(?)", (chat_id,))
+    session_id = c.lastrowid
+    _set_current_session(c, chat_id, session_id)
+    return session_id
+
+
+def _set_current_session(c, chat_id, session_id):
+    c.execute('''INSERT INTO current_chats(chat_id, session_id) VALUES(?, ?)
+                 ON CONFLICT(chat_id) DO UPDATE SET session_id=excluded.session_id''', (chat_id, session_id))
+
+
+## messages_fts is kept in sync by hand, in the same transaction: messages are added to it
+## once written, and removed from it (which needs their text) before they're deleted.
+## where - selects the rows of messages
+def _fts_add_messages(c, where, params):
+    c.execute(f'''INSERT INTO messages_fts(rowid, chat_id, content)
+                  SELECT id, chat_id, content FROM messages_text
+                  WHERE id IN (SELECT message_id FROM messages WHERE {where})''', params)
+
+
+def _delete_messages(c, where, params):
+    c.execute(f'''INSERT INTO messages_fts(messages_fts, rowid, chat_id, content)
+                  SELECT 'delete', id, chat_id, content FROM messages_text
+                  WHERE id IN (SELECT message_id FROM messages WHERE {where})''', params)
+    c.execute(f"DELETE FROM messages WHERE {where}", params)
+
+
+## JSON array of {"role", "content"} -> messages rows, done inside SQLite
+def _messages_from_json(c, session_id, chat_history_str, first_seq=0):
+    c.execute('''INSERT INTO messages(session_id, seq, role, content)
+                 SELECT ?, ? + key, json_extract(value, '$.role'), text_encode(json_extract(value, '$.content'))
+                 FROM json_each(?)''', (session_id, first_seq, chat_history_str))
+    _fts_add_messages(c, "session_id=? AND seq>=?", (session_id, first_seq))
+
+
 def history_get(chat_id):
-    conn = sqlite3.connect('y_userdata.db')
-    c = conn.cursor()
-    c.execute("SELECT chat_history FROM current_chats WHERE chat_id=?", (chat_id,))
-    history_str = c.fetchone()[0]
-    history = json.loads(history_str)
-    conn.close()
-    return history
+    with reading() as c:
+        c.execute('''SELECT role, content FROM messages
+                     WHERE session_id=(SELECT session_id FROM current_chats WHERE chat_id=?) ORDER BY seq''',
+                  (chat_id,))
+        rows = c.fetchall()
+    return [{"role": role, "content": text_decode(content)} for role, content in rows]
+
 
+## Same as history_get(), but with seq and cached token_count of every message
+def history_get_rows(chat_id):
+    with reading() as c:
+        c.execute('''SELECT seq, role, content, token_count FROM messages
+                     WHERE session_id=(SELECT session_id FROM current_chats WHERE chat_id=?) ORDER BY seq''',
+                  (chat_id,))
+        rows = c.fetchall()
+    return [(seq, role, text_decode(content), token_count) for seq, role, content, token_count in rows]
 
+
+## counts - [(seq, token_count), ...]
+def history_set_token_counts(chat_id, counts):
+    with transaction() as c:
+        c.executemany('''UPDATE messages SET token_count=?
+                         WHERE session_id=(SELECT session_id FROM current_chats WHERE chat_id=?) AND seq=?''',
+                      [(token_count, chat_id, seq) for seq, token_count in counts])
+
+
+## Appends new messages to the end of the conversation.
+## keep - if set, only the newest `keep` messages survive (same transaction)
+## token_counts - optional token count for each of the messages
+def history_append(chat_id, messages, keep=None, token_counts=None):
+    if token_counts is None:
+        token_counts = [None] * len(messages)
+    with transaction() as c:
+        session_id = _current_session(c, chat_id)
+        c.execute("SELECT COALESCE(MAX(seq) + 1, 0) FROM messages WHERE session_id=?", (session_id,))
+        next_seq = c.fetchone()[0]
+        c.executemany("INSERT INTO messages(session_id, seq, role, content, token_count) VALUES(?, ?, ?, ?, ?)",
+                      [(session_id, next_seq + i, m["role"], text_encode(m["content"]), token_count)
+                       for i, (m, token_count) in enumerate(zip(messages, token_counts))])
+        _fts_add_messages(c, "session_id=? AND seq>=?", (session_id, next_seq))
+        if keep is not None:
+            history_trim(chat_id, keep)
+
+
+## Drops everything but the newest `keep` messages
+def history_trim(chat_id, keep):
+    with transaction() as c:
+        session_id = _current_session(c, chat_id)
+        if keep <= 0:
+            _delete_messages(c, "session_id=?", (session_id,))
+        else:
+            _delete_messages(c, '''session_id=? AND seq < (
+                                   SELECT seq FROM messages WHERE session_id=? ORDER BY seq DESC LIMIT 1 OFFSET ?)''',
+                             (session_id, session_id, keep - 1))
+
+
+## Replaces messages first_seq..last_seq (those still there) with one message, at last_seq
+def history_compact(chat_id, first_seq, last_seq, message, token_count=None):
+    with transaction() as c:
+        session_id = _current_session(c, chat_id)
+        _delete_messages(c, "session_id=? AND seq BETWEEN ? AND ?", (session_id, first_seq, last_seq))
+        c.execute("INSERT INTO messages(session_id, seq, role, content, token_count) VALUES(?, ?, ?, ?, ?)",
+                  (session_id, last_seq, message["role"], text_encode(message["content"]), token_count))
+        _fts_add_messages(c, "session_id=? AND seq=?", (session_id, last_seq))
+
+
+## Replaces the whole conversation
 def history_update(chat_id, chat_history):
     chat_history_str = json.dumps(chat_history, ensure_ascii=False)
-    conn = sqlite3.connect('y_userdata.db')
-    c = conn.cursor()
-    c.execute("UPDATE current_chats SET chat_history=? WHERE chat_id=?", (chat_history_str, chat_id))
-    conn.commit()
-    conn.close()
+    with transaction() as c:
+        session_id = _current_session(c, chat_id)
+        _delete_messages(c, "session_id=?", (session_id,))
+        _messages_from_json(c, session_id, chat_history_str)
 
 
 #####################
 ## CHAT_MANAGEMENT ##
 #####################
 
+## Saving and loading only move the chat's current_chats.session_id pointer and a session's name,
+## the messages (and their entries in messages_fts) stay where they are. Only the name is
+## (un)indexed in session_names_fts, by hand as well
+def _fts_add_name(c, session_id):
+    c.execute('''INSERT INTO session_names_fts(rowid, chat_id, name)
+                 SELECT id, chat_id, name FROM session_names WHERE id=?''', (session_id,))
+
+
+## where - selects the rows of sessions
+def _fts_remove_names(c, where, params):
+    c.execute(f'''INSERT INTO session_names_fts(session_names_fts, rowid, chat_id, name)
+                  SELECT 'delete', id, chat_id, name FROM session_names
+                  WHERE id IN (SELECT session_id FROM sessions WHERE {where})''', params)
+
 
+## unicode61 splits on '-', so negative (group) chat_ids get 'n' instead
+def _fts_chat(chat_id):
+    return f"c{chat_id}".replace("-", "n")
+
+
+## All of the words of text must match in one of the columns, as whole words or as prefixes
+## (several times slower over message content). Quoted, so nothing typed is taken as FTS5 syntax.
+## text must have at least one word, or the query would match every row of the chat
+def _fts_match(chat_id, columns, text, prefix=False):
+    star = "*" if prefix else ""
+    words = " ".join(f'"{word}"{star}' for word in re.findall(r"\w+", text))
+    return f'chat_id : "{_fts_chat(chat_id)}" AND {{{columns}}} : ({words})'
+
+
+## [(session_id, name)] - the exact name if it's saved, else every saved chat whose name has all of the words
+def _find_saved_chats(c, chat_id, chat_name):
+    c.execute("SELECT session_id, name FROM sessions WHERE chat_id=? AND name=?", (chat_id, chat_name))
+    results = c.fetchall()
+    if not results and re.search(r"\w", chat_name):
+        c.execute('''SELECT session_id, name FROM sessions WHERE session_id IN
+                     (SELECT rowid FROM session_names_fts WHERE session_names_fts MATCH ?) ORDER BY name''',
+                  (_fts_match(chat_id, "name", chat_name, prefix=True),))
+        results = c.fetchall()
+    return results
+
+
+## where - selects the rows of sessions
+def _delete_sessions(c, where, params):
+    _fts_remove_names(c, where, params)
+    _delete_messages(c, f"session_id IN (SELECT session_id FROM sessions WHERE {where})", params)
+    c.execute(f"DELETE FROM sessions WHERE {where}", params)
+
+
+## The current session gets the name (replacing a chat saved under it) and a new empty one becomes current
 def chat_save(chat_id, chat_name):
-    current_history = history_get(chat_id)
-    chat_history_str = json.dumps(current_history, ensure_ascii=False)
-    conn = sqlite3.connect('y_userdata.db')
-    c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO saved_chats(chat_id, chat_name, chat_history) VALUES(?, ?, ?)",
-              (chat_id, chat_name, chat_history_str))
-    conn.commit()
-    conn.close()
-    chat_forget(chat_id)
+    with transaction() as c:
+        session_id = _current_session(c, chat_id)
+        _delete_sessions(c, "chat_id=? AND name=?", (chat_id, chat_name))
+        c.execute("UPDATE sessions SET name=? WHERE session_id=?", (chat_name, session_id))
+        _fts_add_name(c, session_id)
+        c.execute("INSERT INTO sessions(chat_id) VALUES(?)", (chat_id,))
+        _set_current_session(c, chat_id, c.lastrowid)
 
 
+## The saved session loses its name and becomes current, the current one is dropped
 def chat_load(chat_id, chat_name):
-    conn = sqlite3.connect('y_userdata.db')
-    c = conn.cursor()
-    c.execute("SELECT chat_name, chat_history FROM saved_chats WHERE chat_id=? AND chat_name LIKE ?", (chat_id, f"%{chat_name}%"))
-    results = c.fetchall()
-    
-    if len(results) == 0:
-        response_message = f"❔ No chats found for \"{chat_name}\""
-    elif len(results) > 1:
-        matching_chats = "\n".join(result[0] for result in results)
-        response_message = f"❔ Multiple chats found for \"{chat_name}\":\n{matching_chats}\n\nPick specific one!"
-    else:
-        result = results[0]
-        history_str = result[1]
-        history = json.loads(history_str)
-        history_update(chat_id, history)
-        c.execute("DELETE FROM saved_chats WHERE chat_id=? AND chat_name=?", (chat_id, result[0]))
-        conn.commit()
-        response_message = f"✨ Chat '{result[0]}' loaded!"
-
-    conn.close()
+    with transaction() as c:
+        results = _find_saved_chats(c, chat_id, chat_name)
+
+        if len(results) == 0:
+            response_message = f"❔ No chats found for \"{chat_name}\""
+        elif len(results) > 1:
+            matching_chats = "\n".join(result[1] for result in results)
+            response_message = f"❔ Multiple chats found for \"{chat_name}\":\n{matching_chats}\n\nPick specific one!"
+        else:
+            session_id, name = results[0]
+            _delete_sessions(c, "session_id=(SELECT session_id FROM current_chats WHERE chat_id=?)", (chat_id,))
+            _fts_remove_names(c, "session_id=?", (session_id,))
+            c.execute("UPDATE sessions SET name=NULL WHERE session_id=?", (session_id,))
+            _set_current_session(c, chat_id, session_id)
+            response_message = f"✨ Chat '{name}' loaded!"
+
     return response_message
 
 
 def chat_forget(chat_id, chat_name=""):
-    conn = sqlite3.connect('y_userdata.db')
-    c = conn.cursor()
-    
-    if chat_name == "":
-        # Current chat
-        c.execute("UPDATE current_chats SET chat_history='[]' WHERE chat_id=?", (chat_id,))
-        response_message = "✨ History cleared!"
-    elif chat_name.lower() == "all":
-        # All chats
-        c.execute("DELETE FROM saved_chats WHERE chat_id=?", (chat_id,))
-        c.execute("UPDATE current_chats SET chat_history='[]' WHERE chat_id=?", (chat_id,))
-        response_message = "✨ History cleared for all chats!"
-    else:
-        # Specific chat 
-        c.execute("SELECT chat_name FROM saved_chats WHERE chat_id=? AND chat_name LIKE ?", (chat_id, f"%{chat_name}%"))
-        matches = c.fetchall()
-        if len(matches) == 0:
-            response_message = f"❔ No chats found for \"{chat_name}\""
-        elif len(matches) > 1:
-            matching_chats = "\n".join(match[0] for match in matches)
-            response_message = f"❔ Multiple chats found for \"{chat_name}\":\n{matching_chats}\n\nPick specific one!"
+    with transaction() as c:
+        if chat_name == "":
+            # Current chat
+            _delete_messages(c, "session_id=(SELECT session_id FROM current_chats WHERE chat_id=?)", (chat_id,))
+            response_message = "✨ History cleared!"
+        elif chat_name.lower() == "all":
+            # All chats
+            _delete_sessions(c, "chat_id=? AND name IS NOT NULL", (chat_id,))
+            _delete_messages(c, "session_id=(SELECT session_id FROM current_chats WHERE chat_id=?)", (chat_id,))
+            response_message = "✨ History cleared for all chats!"
         else:
-            c.execute("DELETE FROM saved_chats WHERE chat_id=? AND chat_name=?", (chat_id, matches[0][0]))
-            response_message = f"✨ Chat '{matches[0][0]}' deleted!"
-    
-    conn.commit()
-    conn.close()
+            # Specific chat 
+            matches = _find_saved_chats(c, chat_id, chat_name)
+            if len(matches) == 0:
+                response_message = f"❔ No chats found for \"{chat_name}\""
+            elif len(matches) > 1:
+                matching_chats = "\n".join(match[1] for match in matches)
+                response_message = f"❔ Multiple chats found for \"{chat_name}\":\n{matching_chats}\n\nPick specific one!"
+            else:
+                session_id, name = matches[0]
+                _delete_sessions(c, "session_id=?", (session_id,))
+                response_message = f"✨ Chat '{name}' deleted!"
+
     return response_message
 
 
 def chat_list(chat_id):
-    conn = sqlite3.connect('y_userdata.db')
-    c = conn.cursor()
-    c.execute("SELECT chat_name FROM saved_chats WHERE chat_id=?", (chat_id,))
-    chats = c.fetchall()
-    conn.close()
+    with reading() as c:
+        c.execute("SELECT name FROM sessions WHERE chat_id=? AND name IS NOT NULL ORDER BY name", (chat_id,))
+        chats = c.fetchall()
     return [chat[0] for chat in chats]
+
+
+## [(chat_name, snippet)] of the user's saved chats with all of the words in the name or in one
+## of the messages, best matches first. The snippet is from the best message, "" if only the name matched
+def chat_search(chat_id, query, limit=SEARCH_RESULTS):
+    if not re.search(r"\w", query):
+        return []
+    with reading() as c:
+        # bm25 is negative, lower is better. A chat ranks by its best message.
+        # MATERIALIZED, or SQLite flattens the subquery and bm25 ends up outside of the FTS query
+        c.execute('''WITH hits AS MATERIALIZED
+                       (SELECT rowid AS message_id, bm25(messages_fts, 0, 1.0) AS score FROM messages_fts
+                        WHERE messages_fts MATCH ?)
+                     SELECT session_id, name, message_id, min(score)
+                     FROM hits JOIN messages USING (message_id) JOIN sessions USING (session_id)
+                     WHERE name IS NOT NULL GROUP BY session_id''',
+                  (_fts_match(chat_id, "content", query),))
+        found = {session_id: [name, message_id, score] for session_id, name, message_id, score in c.fetchall()}
+        c.execute('''SELECT id, session_names.name, bm25(session_names_fts, 0, 1.0) FROM session_names_fts
+                     JOIN session_names ON id = session_names_fts.rowid WHERE session_names_fts MATCH ?''',
+                  (_fts_match(chat_id, "name", query),))
+        for session_id, name, score in c.fetchall():
+            found.setdefault(session_id, [name, None, 0])[2] += score * NAME_WEIGHT
+        top = sorted(found.values(), key=lambda result: result[2])[:limit]
+
+        # The text for snippets is decoded for the top ones only
+        message_ids = [message_id for _, message_id, _ in top if message_id is not None]
+        c.execute(f'''SELECT rowid, snippet(messages_fts, 1, '«', '»', '…', ?) FROM messages_fts
+                      WHERE messages_fts MATCH ? AND rowid IN ({",".join("?" * len(message_ids))})''',
+                  (SNIPPET_TOKENS, _fts_match(chat_id, "content", query), *message_ids))
+        snippets = dict(c.fetchall())
+    return [(name, snippets.get(message_id, "")) for name, message_id, _ in top]
+
+
+###########
+## CACHE ##
+###########
+
+
+## Returns cached text or None. Entries older than ttl seconds count as missing
+def cache_get(namespace, key, ttl=None):
+    now = time.time()
+    with transaction() as c:
+        stats = _cache_stats.setdefault(namespace, [0, 0])
+        c.execute("SELECT value, created_at FROM cache WHERE namespace=? AND key=?", (namespace, key))
+        result = c.fetchone()
+        if result is not None and ttl is not None and now - result[1] > ttl:
+            c.execute("DELETE FROM cache WHERE namespace=? AND key=?", (namespace, key))
+            result = None
+        if result is None:
+            stats[1] += 1
+            return None
+        stats[0] += 1
+        value = result[0]
+        c.execute("UPDATE cache SET accessed_at=? WHERE namespace=? AND key=?", (now, namespace, key))
+    return zlib.decompress(value).decode('utf-8')
+
+
+## Whether the key is cached (and not older than ttl), without counting a hit or miss or touching the LRU order
+def cache_has(namespace, key, ttl=None):
+    with reading() as c:
+        c.execute("SELECT created_at FROM cache WHERE namespace=? AND key=?", (namespace, key))
+        result = c.fetchone()
+    return result is not None and (ttl is None or time.time() - result[0] <= ttl)
+
+
+## Stores text under the key, then evicts expired entries and least recently used ones
+## until the namespace fits into max_bytes (compressed)
+def cache_put(namespace, key, value, max_bytes=None, ttl=None):
+    now = time.time()
+    value = zlib.compress(value.encode('utf-8'))
+    with transaction() as c:
+        c.execute('''INSERT OR REPLACE INTO cache(namespace, key, value, size, created_at, accessed_at)
+                     VALUES(?, ?, ?, ?, ?, ?)''', (namespace, key, value, len(value), now, now))
+        if ttl is not None:
+            c.execute("DELETE FROM cache WHERE namespace=? AND created_at < ?", (namespace, now - ttl))
+        if max_bytes is not None:
+            c.execute("SELECT COALESCE(SUM(size), 0) FROM cache WHERE namespace=?", (namespace,))
+            total = c.fetchone()[0]
+            if total > max_bytes:
+                c.execute("SELECT key, size FROM cache WHERE namespace=? ORDER BY accessed_at", (namespace,))
+                evict = []
+                for old_key, size in c.fetchall():
+                    if total <= max_bytes:
+                        break
+                    evict.append((namespace, old_key))
+                    total -= size
+                c.executemany("DELETE FROM cache WHERE namespace=? AND key=?", evict)
+
+
+## Clears one namespace, or every cache if namespace is None
+def cache_clear(namespace=None):
+    with transaction() as c:
+        if namespace is None:
+            c.execute("DELETE FROM cache")
+        else:
+            c.execute("DELETE FROM cache WHERE namespace=?", (namespace,))
+
+
+## {namespace: {'entries', 'bytes', 'hits', 'misses'}}
+def cache_stats():
+    with reading() as c:
+        c.execute("SELECT namespace, COUNT(*), COALESCE(SUM(size), 0) FROM cache GROUP BY namespace")
+        rows = c.fetchall()
+        stats = {namespace: {'entries': 0, 'bytes': 0, 'hits': hits, 'misses': misses}
+                 for namespace, (hits, misses) in _cache_stats.items()}
+    for namespace, entries, size in rows:
+        stats.setdefault(namespace, {'entries': 0, 'bytes': 0, 'hits': 0, 'misses': 0})
+        stats[namespace].update(entries=entries, bytes=size)
+    return stats
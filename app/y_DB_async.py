@@ -0,0 +1,148 @@
+"""
+Async facade over y_DB for the bot handlers and y_GPT.
+
+Every call is shipped to one dedicated DB thread, so a slow SQLite read or commit
+never freezes the event loop, and the connection is only ever used from that thread.
+Functions mirror y_DB one-to-one and take the same arguments.
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import y_DB
+from y_metrics import track
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="y_DB")
+
+
+async def run_db(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    with track(f"db.{func.__name__}"):  # Waiting for the DB thread included
+        return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+def shutdown():
+    _executor.submit(y_DB.close_connection)
+    _executor.shutdown(wait=True)
+
+
+##########
+## INIT ##
+##########
+
+
+async def init_db():
+    return await run_db(y_DB.init_db)
+
+
+async def init_user(chat_id):
+    return await run_db(y_DB.init_user, chat_id)
+
+
+async def compress_messages():
+    return await run_db(y_DB.compress_messages)
+
+
+##############
+## SETTINGS ##
+##############
+
+
+async def settings_get(chat_id):
+    return await run_db(y_DB.settings_get, chat_id)
+
+
+async def key_get(chat_id, key):
+    return await run_db(y_DB.key_get, chat_id, key)
+
+
+async def key_set(chat_id, key, value):
+    return await run_db(y_DB.key_set, chat_id, key, value)
+
+
+async def key_remove(chat_id, key):
+    return await run_db(y_DB.key_remove, chat_id, key)
+
+
+#############
+## HISTORY ##
+#############
+
+
+async def history_get(chat_id):
+    return await run_db(y_DB.history_get, chat_id)
+
+
+async def history_get_rows(chat_id):
+    return await run_db(y_DB.history_get_rows, chat_id)
+
+
+async def history_set_token_counts(chat_id, counts):
+    return await run_db(y_DB.history_set_token_counts, chat_id, counts)
+
+
+async def history_append(chat_id, messages, keep=None, token_counts=None):
+    return await run_db(y_DB.history_append, chat_id, messages, keep, token_counts)
+
+
+async def history_trim(chat_id, keep):
+    return await run_db(y_DB.history_trim, chat_id, keep)
+
+
+async def history_compact(chat_id, first_seq, last_seq, message, token_count=None):
+    return await run_db(y_DB.history_compact, chat_id, first_seq, last_seq, message, token_count)
+
+
+async def history_update(chat_id, chat_history):
+    return await run_db(y_DB.history_update, chat_id, chat_history)
+
+
+#####################
+## CHAT_MANAGEMENT ##
+#####################
+
+
+async def chat_save(chat_id, chat_name):
+    return await run_db(y_DB.chat_save, chat_id, chat_name)
+
+
+async def chat_load(chat_id, chat_name):
+    return await run_db(y_DB.chat_load, chat_id, chat_name)
+
+
+async def chat_forget(chat_id, chat_name=""):
+    return await run_db(y_DB.chat_forget, chat_id, chat_name)
+
+
+async def chat_list(chat_id):
+    return await run_db(y_DB.chat_list, chat_id)
+
+
+async def chat_search(chat_id, query, limit=y_DB.SEARCH_RESULTS):
+    return await run_db(y_DB.chat_search, chat_id, query, limit)
+
+
+###########
+## CACHE ##
+###########
+
+
+async def cache_get(namespace, key, ttl=None):
+    return await run_db(y_DB.cache_get, namespace, key, ttl)
+
+
+async def cache_has(namespace, key, ttl=None):
+    return await run_db(y_DB.cache_has, namespace, key, ttl)
+
+
+async def cache_put(namespace, key, value, max_bytes=None, ttl=None):
+    return await run_db(y_DB.cache_put, namespace, key, value, max_bytes, ttl)
+
+
+async def cache_clear(namespace=None):
+    return await run_db(y_DB.cache_clear, namespace)
+
+
+async def cache_stats():
+    return await run_db(y_DB.cache_stats)
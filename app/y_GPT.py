@@ -1,10 +1,23 @@
 import os
 import re
+import asyncio
+import logging
 import base64
+import binascii
 import openai
 from openai import AsyncOpenAI
 import tiktoken
 import json
+import functools
+import hashlib
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+# Optional, only used to downscale images before sending them to Vision
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 from youtube_transcript_api import ( 
     YouTubeTranscriptApi, 
@@ -13,23 +26,135 @@ from youtube_transcript_api import (
     NoTranscriptAvailable
 )
 
-from y_DB import (
-    history_get,
-    history_update,
-    key_get
+from y_metrics import (
+    track,
+    tracked,
+    record_usage
+)
+
+from y_ratelimit import (
+    RateLimiter,
+    call_with_retries,
+    DEFAULT_RPM,
+    DEFAULT_TPM
+)
+
+from y_DB_async import (
+    history_get_rows,
+    history_set_token_counts,
+    history_append,
+    history_compact,
+    settings_get,
+    cache_get,
+    cache_has,
+    cache_put
 )
 
 from dotenv import load_dotenv
 load_dotenv("y_secrets.env")
 
+logger = logging.getLogger(__name__)
+
 openai.api_key = os.getenv("OPENAI_API_KEY")
-openai_client = AsyncOpenAI()
+openai_client = AsyncOpenAI(max_retries=0)  # Retries are done by y_ratelimit
+rate_limiter = RateLimiter(
+    rpm=int(os.getenv("OPENAI_RPM") or DEFAULT_RPM),
+    tpm=int(os.getenv("OPENAI_TPM") or DEFAULT_TPM),
+    share=1 / int(os.getenv("WORKERS") or 1)  # Every worker process has its own limiter
+)
 
 DEFAULT_MODEL              = "gpt-4o-mini"
 DEFAULT_TEMPERATURE        = "0.7"
 DEFAULT_PROMPT             = "You are a helpful assistant"
 DEFAULT_MAX_TOKENS         = "3000"
 DEFAULT_MAX_HISTORY_TOKENS = "4096"
+DEFAULT_STREAM             = "on"
+DEFAULT_SUMMARY_CHUNK_TOKENS = "12000"  # Longer transcripts are summarized in chunks, then combined
+DEFAULT_SUMMARY_PARALLELISM  = "4"      # Chunks summarized at once
+DEFAULT_IMAGE_DETAIL       = "auto"     # Vision detail: low / high / auto
+DEFAULT_IMAGE_SIZE         = "768"      # Shorter side (px) of the photo we download and send
+DEFAULT_COALESCE_MS        = "0"        # Merge messages arriving within this window into one query, 0 = off
+DEFAULT_COMPACT_AFTER_TOKENS = "0"      # Longer history gets its older part summarized into a memory, 0 = off
+DEFAULT_MEMORY_TOKENS        = "500"    # Size of that memory
+
+TRANSCRIPT_CACHE_TTL       = 7 * 24 * 3600      # Seconds
+TRANSCRIPT_CACHE_MAX_BYTES = 64 * 1024 * 1024   # Compressed
+TRANSCRIPT_WORKERS         = 4                  # Max YouTube fetches at once
+TRANSCRIPT_FETCH_TIMEOUT   = 30                 # Seconds
+SUMMARY_CACHE_TTL          = 30 * 24 * 3600
+SUMMARY_CACHE_MAX_BYTES    = 16 * 1024 * 1024
+VISION_CACHE_TTL           = 30 * 24 * 3600
+VISION_CACHE_MAX_BYTES     = 16 * 1024 * 1024
+
+## youtube_transcript_api is blocking, so fetches run on their own small pool
+_transcript_executor = ThreadPoolExecutor(max_workers=TRANSCRIPT_WORKERS, thread_name_prefix="transcripts")
+_transcript_tasks = {}  # In-flight fetches, shared by everyone asking for the same transcript
+
+MAX_OPENAI_CALLS = 16   # In flight at once, across all chats
+_openai_semaphore = asyncio.Semaphore(MAX_OPENAI_CALLS)
+_chat_tails = {}        # chat_id: future of the last ChatTurn queued in that chat
+_compactions = {}       # chat_id: compact_history() task running for that chat
+
+MEMORY_MARKER = "[MEMORY_OF_EARLIER_CONVERSATION]:"
+
+def parse_bool(value):
+    if value.lower() in ("on", "true", "yes", "1"):
+        return True
+    if value.lower() in ("off", "false", "no", "0"):
+        return False
+    raise ValueError("use on or off")
+
+
+def parse_image_detail(value):
+    if value.lower() not in ("low", "high", "auto"):
+        raise ValueError("use low, high or auto")
+    return value.lower()
+
+
+def parse_milliseconds(value):
+    parsed = int(value)
+    if not 0 <= parsed <= 10000:
+        raise ValueError("must be between 0 and 10000")
+    return parsed
+
+
+def parse_chunk_tokens(value):
+    parsed = int(value)
+    if not 1000 <= parsed <= 100000:
+        raise ValueError("must be between 1000 and 100000")
+    return parsed
+
+
+def parse_parallelism(value):
+    parsed = int(value)
+    if not 1 <= parsed <= MAX_OPENAI_CALLS:
+        raise ValueError(f"must be between 1 and {MAX_OPENAI_CALLS}")
+    return parsed
+
+
+def parse_tokens_or_off(value):
+    parsed = int(value)
+    if parsed < 0:
+        raise ValueError("must be a positive number, or 0 for off")
+    return parsed
+
+
+## setting: (parser, default)
+SETTINGS = {
+    'model':              (str,   DEFAULT_MODEL),
+    'prompt':             (str,   DEFAULT_PROMPT),
+    'temperature':        (float, DEFAULT_TEMPERATURE),
+    'max_tokens':         (int,   DEFAULT_MAX_TOKENS),
+    'max_history_tokens': (int,   DEFAULT_MAX_HISTORY_TOKENS),
+    'stream':             (parse_bool, DEFAULT_STREAM),
+    'summary_chunk_tokens': (parse_chunk_tokens, DEFAULT_SUMMARY_CHUNK_TOKENS),
+    'summary_parallelism':  (parse_parallelism, DEFAULT_SUMMARY_PARALLELISM),
+    'image_detail':       (parse_image_detail, DEFAULT_IMAGE_DETAIL),
+    'image_size':         (int,   DEFAULT_IMAGE_SIZE),
+    'coalesce_ms':        (parse_milliseconds, DEFAULT_COALESCE_MS),
+    'compact_after_tokens': (parse_tokens_or_off, DEFAULT_COMPACT_AFTER_TOKENS),
+    'memory_tokens':        (int, DEFAULT_MEMORY_TOKENS),
+}
 
 
 ######################
@@ -42,6 +167,54 @@ def encode_image(image_path):
         return base64.b64encode(image_file.read()).decode('utf-8')
 
 
+def make_cache_key(*parts):
+    key = json.dumps(parts, ensure_ascii=False)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+## Same video + same (normalized) questions + same settings = same summary
+def summary_cache_key(video_id, questions, model, prompt, temperature, max_tokens):
+    normalized_questions = " ".join(questions.lower().split())
+    return make_cache_key(video_id, normalized_questions, model, prompt, temperature, max_tokens)
+
+
+DATA_URL_PREFIX = b"data:image/jpeg;base64,"
+BASE64_CHUNK = 3 * 16384   # Multiple of 3, so chunks encode without padding in between
+
+
+## Vision never looks at more than this: low detail fits the image into 512x512 (so this is
+## the longer side), high detail into 2048x2048 with the shorter side scaled to 768
+def image_target_size(detail, image_size):
+    return min(image_size, 512) if detail == "low" else image_size
+
+
+## Raw JPEG bytes -> data URL, downscaled first if Pillow is available and the image is bigger than needed
+def encode_image_url(image_bytes, detail, image_size):
+    if Image is not None:
+        with Image.open(BytesIO(image_bytes)) as image:
+            width, height = image.size
+            if detail == "low":
+                scale = min(1, 512 / max(width, height))
+            else:
+                scale = min(1, image_size / min(width, height), 2048 / max(width, height))
+            if scale < 1:
+                image = image.convert("RGB").resize((max(1, round(width * scale)), max(1, round(height * scale))))
+                out = BytesIO()
+                image.save(out, format="JPEG", quality=85)
+                image_bytes = out.getbuffer()
+
+    # Encoded chunk by chunk straight into the URL's buffer, the str is the only other full copy
+    data = memoryview(image_bytes)
+    url = bytearray(len(DATA_URL_PREFIX) + 4 * ((len(data) + 2) // 3))
+    url[:len(DATA_URL_PREFIX)] = DATA_URL_PREFIX
+    position = len(DATA_URL_PREFIX)
+    for i in range(0, len(data), BASE64_CHUNK):
+        encoded = binascii.b2a_base64(data[i:i + BASE64_CHUNK], newline=False)
+        url[position:position + len(encoded)] = encoded
+        position += len(encoded)
+    return url.decode('ascii')
+
+
 def extract_video_id(url):
     # "...youtube.com/watch?v=..." or "...youtu.be/..."
     pattern = r'(?:v=|\/)([0-9A-Za-z_-]{11}).*'
@@ -50,7 +223,55 @@ def extract_video_id(url):
 
 
 # Combine the transcript into a single string
+# Transcripts are cached per (video_id, lang), including the auto-generated fallback
 async def get_video_transcript(video_id, lang='en'):
+    return await asyncio.shield(prefetch_video_transcript(video_id, lang))
+
+
+# Starts getting the transcript in the background (if not started already), returns the task
+def prefetch_video_transcript(video_id, lang='en'):
+    cache_key = f"{video_id}:{lang}"
+    task = _transcript_tasks.get(cache_key)
+    if task is None:
+        task = asyncio.ensure_future(_load_video_transcript(video_id, lang, cache_key))
+        task.add_done_callback(lambda _: _prefetch_done(cache_key, task))
+        _transcript_tasks[cache_key] = task
+    return task
+
+
+## Nobody may await a prefetch (e.g. the summary turned out to be cached), so its error is consumed
+## here instead of asyncio logging "Task exception was never retrieved". Whoever awaits it still gets it
+def _prefetch_done(cache_key, task):
+    _transcript_tasks.pop(cache_key, None)
+    if not task.cancelled():
+        task.exception()
+
+
+## prefetch_video_transcript() for GPT_summarize(), unless the summary it'd make is cached already
+async def prefetch_summary_transcript(chat_id, video_link, questions):
+    settings = await load_settings(chat_id)
+    video_id = extract_video_id(video_link)
+    summary_key = summary_cache_key(video_id, questions, settings['model'], settings['prompt'],
+                                    settings['temperature'], settings['max_tokens'])
+    if not await cache_has('summaries', summary_key, ttl=SUMMARY_CACHE_TTL):
+        prefetch_video_transcript(video_id)
+
+
+async def _load_video_transcript(video_id, lang, cache_key):
+    transcript_text = await cache_get('transcripts', cache_key, ttl=TRANSCRIPT_CACHE_TTL)
+    if transcript_text is None:
+        loop = asyncio.get_running_loop()
+        with track("transcript"):
+            transcript_text = await asyncio.wait_for(
+                loop.run_in_executor(_transcript_executor, fetch_video_transcript, video_id, lang),
+                TRANSCRIPT_FETCH_TIMEOUT
+            )
+        await cache_put('transcripts', cache_key, transcript_text,
+                        max_bytes=TRANSCRIPT_CACHE_MAX_BYTES, ttl=TRANSCRIPT_CACHE_TTL)
+    return transcript_text
+
+
+def fetch_video_transcript(video_id, lang='en'):
     try:
         transcript = YouTubeTranscriptApi.get_transcript(video_id, languages=[lang])
     except (NoTranscriptFound, TranscriptsDisabled, NoTranscriptAvailable):
@@ -62,11 +283,128 @@ async def get_video_transcript(video_id, lang='en'):
         raise
     return " ".join([t['text'] for t in transcript])
 
+## Keeps work inside one chat in arrival order, while different chats run fully in parallel.
+##     async with ChatTurn(chat_id) as turn:   # takes a place in the chat's queue right away
+##         ...                                 # anything that doesn't touch the history can run now
+##         await turn.wait()                   # everything queued before us in this chat is done
+## Chats with nothing queued don't keep any state around.
+class ChatTurn:
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+
+    async def __aenter__(self):
+        self.previous = _chat_tails.get(self.chat_id)
+        self.done = asyncio.get_running_loop().create_future()
+        _chat_tails[self.chat_id] = self.done
+        return self
+
+    async def wait(self):
+        if self.previous is not None:
+            await asyncio.shield(self.previous)
+
+    async def __aexit__(self, *exc_info):
+        # Never hand over before our own predecessors are done, even if we bailed out early
+        if self.previous is None or self.previous.done():
+            self._finish()
+        else:
+            self.previous.add_done_callback(lambda _: self._finish())
+
+    def _finish(self):
+        self.done.set_result(None)
+        if _chat_tails.get(self.chat_id) is self.done:
+            del _chat_tails[self.chat_id]
+
+
+## Rough upper bound of what a request costs against the tokens-per-minute limit:
+## ~4 characters per token of text, a flat rate per image, plus everything max_tokens allows
+def estimate_request_tokens(messages, max_tokens):
+    chars, images = 0, 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            chars += len(content)
+        else:
+            for part in content:
+                if part["type"] == "text":
+                    chars += len(part["text"])
+                else:
+                    images += 1
+    return chars // 4 + images * 765 + (max_tokens or 0)
+
+
+## Returns the text of the completion.
+## on_delta - if set, the completion is streamed and on_delta(text_piece) is awaited for every piece
+## At most MAX_OPENAI_CALLS completions are in flight at once, all of them go through rate_limiter
+@tracked("openai")
+async def create_completion(on_delta=None, **kwargs):
+    if on_delta is not None:
+        kwargs['stream_options'] = {"include_usage": True}  # Usage comes in one last chunk without choices
+    async with _openai_semaphore:
+        raw_response = await call_with_retries(
+            rate_limiter,
+            lambda: openai_client.chat.completions.with_raw_response.create(stream=on_delta is not None, **kwargs),
+            estimate_request_tokens(kwargs['messages'], kwargs.get('max_tokens'))
+        )
+        if on_delta is None:
+            completion = raw_response.parse()
+            record_usage(kwargs['model'], completion.usage)
+            return completion.choices[0].message.content
+
+        stream = raw_response.parse()
+        parts = []
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                await on_delta(chunk.choices[0].delta.content)
+            if chunk.usage:
+                record_usage(kwargs['model'], chunk.usage)
+        return "".join(parts)
+
+
+## Splits text into pieces of at most chunk_tokens tokens
+def split_by_tokens(text, encoding, chunk_tokens):
+    tokens = encoding.encode(text)
+    return [encoding.decode(tokens[i:i + chunk_tokens]) for i in range(0, len(tokens), chunk_tokens)]
+
+
+## Map step for long transcripts: every chunk is summarized on its own, up to `parallelism` at once
+async def summarize_transcript_chunks(chunks, model, prompt, temperature, max_tokens, parallelism):
+    semaphore = asyncio.Semaphore(parallelism)
+
+    async def summarize_chunk(i, chunk):
+        async with semaphore:
+            return await create_completion(
+                model=model,
+                messages=[
+                    {"role": "system", "content": prompt},
+                    {"role": "system", "content": f"Summarize part {i + 1} of {len(chunks)} of a video transcript. "
+                                                  f"Keep every fact, name and number that matters:\n\n{chunk}"}
+                ],
+                temperature=temperature,
+                max_tokens=max_tokens
+            )
+
+    return await asyncio.gather(*(summarize_chunk(i, chunk) for i, chunk in enumerate(chunks)))
+
+
 ## generate_video_summary() bypasses GPT_history, because transcripts can get really large
 ## this makes them effectively clear history when limit_history() kicks in 
+## Transcripts longer than chunk_tokens are map-reduced: chunks are summarized concurrently,
+## then a single reduce pass combines them and answers the questions
 async def generate_video_summary(
         transcript, questions,
-        model, prompt, temperature, max_tokens):
+        model, prompt, temperature, max_tokens, on_delta=None,
+        chunk_tokens=None, parallelism=1):
+    if chunk_tokens:
+        chunks = await asyncio.to_thread(split_by_tokens, transcript, get_encoding(model), chunk_tokens)
+        if len(chunks) > 1:
+            chunk_summaries = await summarize_transcript_chunks(
+                chunks, model, prompt, temperature, max_tokens, parallelism
+            )
+            transcript = "\n\n".join(
+                f"[PART {i + 1} OF {len(chunks)}, SUMMARIZED]:\n{summary}" for i, summary in enumerate(chunk_summaries)
+            )
+
     if questions == "":
         messages=[
             {"role": "system", "content": prompt},
@@ -79,7 +417,8 @@ async def generate_video_summary(
             {"role": "user", "content": questions}
         ]
 
-    completion = await openai_client.chat.completions.create(
+    response = await create_completion(
+        on_delta,
         model=model,
         messages=messages,
         temperature=temperature,
@@ -87,39 +426,172 @@ async def generate_video_summary(
     )
     #max_tokens=150  # Adjust the number of tokens based on your needs)
     #temperature=0
-    response = completion.choices[0].message.content.strip()
-    return response
+    return response.strip()
+
+
+## tiktoken.encoding_for_model() resolves the model name on every call, do it once per model
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    return tiktoken.encoding_for_model(model)
+
+
+## Tokens a single message adds to the history: the message itself plus a separator
+## Counted once and stored next to the message in the DB
+def count_tokens(message, encoding):
+    return len(encoding.encode(json.dumps(message, ensure_ascii=False))) + 1
 
 
-## If > MAX_HISTORY_TOKENS, cut oldest messsage and check again until < MAX_HISTORY_TOKENS
+## Current history with a token count for every message
+## Messages stored before token counts existed (or loaded from a saved chat) get counted here once
+async def load_history(chat_id, model):
+    encoding = get_encoding(model)
+    history, token_counts, missing = [], [], []
+    for seq, role, content, token_count in await history_get_rows(chat_id):
+        message = {"role": role, "content": content}
+        if token_count is None:
+            token_count = count_tokens(message, encoding)
+            missing.append((seq, token_count))
+        history.append(message)
+        token_counts.append(token_count)
+    if missing:
+        await history_set_token_counts(chat_id, missing)
+    return history, token_counts
+
+
+## If > MAX_HISTORY_TOKENS, cut oldest messages until < MAX_HISTORY_TOKENS
 ## This check is no longer necessary, as gpt-4o and gpt-4o-mini context window can get as huge as 128k
 ## I still left it in place if user wants to spend less on input tokens
-async def limit_history(history, model, max_history_tokens):
-    encoding = tiktoken.encoding_for_model(model)
-    history_json = json.dumps(history, ensure_ascii=False)      # Convert history to text
-    num_tokens = len(encoding.encode(history_json))             # Calculate number of tokens in the history
-    if num_tokens <= max_history_tokens:
-        return history
-    while num_tokens > max_history_tokens:
-        history.pop(0)                                          # Remove the first item from the history
-        history_json = json.dumps(history, ensure_ascii=False)  # Convert updated history to text
-        num_tokens = len(encoding.encode(history_json))         # Count tokens
+## token_counts is trimmed along with history, so both stay aligned
+@tracked("limit_history")
+async def limit_history(history, model, max_history_tokens, token_counts=None):
+    if token_counts is None:
+        encoding = get_encoding(model)
+        token_counts = [count_tokens(message, encoding) for message in history]
+    num_tokens = sum(token_counts) + 1                          # +1 for the enclosing brackets
+    drop = 0
+    while num_tokens > max_history_tokens and drop < len(history):
+        num_tokens -= token_counts[drop]
+        drop += 1
+    if drop:
+        del history[:drop]
+        del token_counts[:drop]
     return history
 
 
-def load_settings(chat_id):
-    model = key_get(chat_id, 'model') or DEFAULT_MODEL
-    prompt = key_get(chat_id, 'prompt') or DEFAULT_PROMPT
-    temperature = float(key_get(chat_id, 'temperature') or DEFAULT_TEMPERATURE)
-    max_tokens = int(key_get(chat_id, 'max_tokens') or DEFAULT_MAX_TOKENS)
-    max_history_tokens = int(key_get(chat_id, 'max_history_tokens') or DEFAULT_MAX_HISTORY_TOKENS)
-    return {
-        'model': model,
-        'prompt': prompt,
-        'temperature': temperature,
-        'max_tokens': max_tokens,
-        'max_history_tokens': max_history_tokens
-    }
+## With 'compact_after_tokens' set, a history that grew past it doesn't wait for limit_history()
+## to cut its oldest messages: they're summarized into one memory message in the background,
+## and the next requests send the memory instead.
+## Returns (start, cut) - history[start:cut] goes into the memory. The prompt on top stays, and so do
+## the newest messages worth up to half of compact_after_tokens, starting with a whole user turn
+def compaction_range(history, token_counts, compact_after_tokens):
+    start = 0
+    if history and history[0]["role"] == "system" and not history[0]["content"].startswith(MEMORY_MARKER):
+        start = 1
+    cut, kept = len(history), 0
+    while cut > start and kept + token_counts[cut - 1] <= compact_after_tokens // 2:
+        cut -= 1
+        kept += token_counts[cut]
+    cut = min(cut, len(history) - 1)   # The last turn always stays
+    while cut > start and history[cut]["role"] != "user":
+        cut -= 1
+    if cut > start and history[cut - 1]["role"] == "system":
+        cut -= 1    # [PICTURE,OMITTED_IN_CHAT_HISTORY] goes with the caption after it
+    return start, cut
+
+
+## Older messages (and the memory they may start with) -> text of the new memory
+async def summarize_history(messages, model, temperature, memory_tokens):
+    conversation = "\n\n".join(f"{message['role'].upper()}: {message['content']}" for message in messages)
+    memory = await create_completion(
+        model=model,
+        messages=[
+            {"role": "system", "content": "Below is the earlier part of your conversation with the user, it may start "
+                                          "with your memory of an even earlier part. Write down your memory of it: "
+                                          "everything you'd need to carry on - facts, names, numbers, decisions, "
+                                          "the user's preferences and open questions. "
+                                          f"Be brief, at most {memory_tokens * 3 // 4} words."},
+            {"role": "user", "content": conversation}
+        ],
+        temperature=temperature,
+        max_tokens=memory_tokens
+    )
+    return memory.strip()
+
+
+## Starts compact_history() for the chat, unless it's off, not needed or already running
+def schedule_compaction(chat_id, settings, token_counts):
+    compact_after_tokens = settings['compact_after_tokens']
+    if not compact_after_tokens or sum(token_counts) + 1 <= compact_after_tokens or chat_id in _compactions:
+        return
+    task = asyncio.ensure_future(compact_history(chat_id, settings))
+    _compactions[chat_id] = task
+    task.add_done_callback(lambda _: _compaction_done(chat_id, task))
+
+
+def _compaction_done(chat_id, task):
+    del _compactions[chat_id]
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"History compaction failed in chat {chat_id}: {task.exception()!r}")
+
+
+## The summary is written without holding the chat's turn, so the chat goes on meanwhile.
+## Only swapping the messages for it takes the turn: by then limit_history() may have trimmed some
+## of them, which is fine, but if anything else changed them (/f, /load...) the memory is dropped
+@tracked("compact")
+async def compact_history(chat_id, settings):
+    model = settings['model']
+    encoding = get_encoding(model)
+    rows = await history_get_rows(chat_id)
+    history = [{"role": role, "content": content} for _, role, content, _ in rows]
+    token_counts = [count_tokens(message, encoding) if row[3] is None else row[3] for row, message in zip(rows, history)]
+
+    if sum(token_counts) + 1 <= settings['compact_after_tokens']:
+        return  # Compacted meanwhile, the request that started us saw the history before that
+    start, cut = compaction_range(history, token_counts, settings['compact_after_tokens'])
+    if cut - start < 2 or sum(token_counts[start:cut]) <= settings['memory_tokens']:
+        return  # Wouldn't get any shorter
+    memory = await summarize_history(history[start:cut], model, settings['temperature'], settings['memory_tokens'])
+    memory_message = {"role": "system", "content": f"{MEMORY_MARKER}\n{memory}"}
+
+    first_seq, last_seq = rows[start][0], rows[cut - 1][0]
+    expected = [row[:3] for row in rows[start:cut]]
+    async with ChatTurn(chat_id) as turn:
+        await turn.wait()
+        current = [row[:3] for row in await history_get_rows(chat_id) if first_seq <= row[0] <= last_seq]
+        if current and current == expected[len(expected) - len(current):]:
+            await history_compact(chat_id, first_seq, last_seq, memory_message,
+                                  count_tokens(memory_message, encoding))
+
+
+## Raises ValueError if value doesn't fit the setting
+def parse_setting(key, value):
+    parser, default = SETTINGS[key]
+    parsed = parser(value)
+    if parser is float and not 0 <= parsed <= 2:
+        raise ValueError(f"{key} must be between 0 and 2")
+    if parser is int and parsed <= 0:
+        raise ValueError(f"{key} must be a positive number")
+    return parsed
+
+
+## Parsed once per distinct combination of stored settings, not on every request
+@functools.lru_cache(maxsize=1024)
+def _parse_settings(stored):
+    stored = dict(stored)
+    settings = {}
+    for key, (parser, default) in SETTINGS.items():
+        try:
+            settings[key] = parse_setting(key, stored.get(key) or default)
+        except ValueError:
+            settings[key] = parse_setting(key, default)
+    return settings
+
+
+## Returns a shared dict, don't modify it
+@tracked("settings")
+async def load_settings(chat_id):
+    stored = await settings_get(chat_id)
+    return _parse_settings(frozenset(stored.items()))
 
 
 ######################
@@ -127,57 +599,81 @@ def load_settings(chat_id):
 ######################
 
 
-async def GPT_query(chat_id, query):
-    history = history_get(chat_id)
-    settings = load_settings(chat_id)
+## on_delta - see create_completion(), only used if the chat has 'stream' on
+async def GPT_query(chat_id, query, on_delta=None):
+    settings = await load_settings(chat_id)
 
     model = settings['model']
     prompt = settings['prompt']
     temperature = settings['temperature']
     max_tokens = settings['max_tokens']
     max_history_tokens = settings['max_history_tokens']
+    on_delta = on_delta if settings['stream'] else None
+
+    history, token_counts = await load_history(chat_id, model)
+    encoding = get_encoding(model)
 
     if not history:
         history.append({"role": "system", "content": prompt})
-        history_update(chat_id, history)
-
-    history.append({"role": "user", "content": query})
-    history = await limit_history(history, model, max_history_tokens)
+        token_counts.append(count_tokens(history[0], encoding))
+        await history_append(chat_id, history, token_counts=token_counts)
+
+    user_message = {"role": "user", "content": query}
+    user_tokens = count_tokens(user_message, encoding)
+    history.append(user_message)
+    token_counts.append(user_tokens)
+    history = await limit_history(history, model, max_history_tokens, token_counts)
     
-    completion = await openai_client.chat.completions.create(
+    response = await create_completion(
+        on_delta,
         model=model, 
         temperature=temperature,
         messages=history,
         max_tokens=max_tokens
     )
-    response = completion.choices[0].message.content
 
-    history.append({"role": "assistant", "content": response})
-    history_update(chat_id, history)
+    assistant_message = {"role": "assistant", "content": response}
+    assistant_tokens = count_tokens(assistant_message, encoding)
+    history.append(assistant_message)
+    token_counts.append(assistant_tokens)
+    await history_append(chat_id, [user_message, assistant_message], keep=len(history),
+                         token_counts=[user_tokens, assistant_tokens])
+    schedule_compaction(chat_id, settings, token_counts)
     return response
 
 
-async def GPT_summarize(chat_id, video_link, questions):
-    history = history_get(chat_id)
-    settings = load_settings(chat_id)
+async def GPT_summarize(chat_id, video_link, questions, on_delta=None):
+    settings = await load_settings(chat_id)
 
     model = settings['model']
     prompt = settings['prompt']
     temperature = settings['temperature']
     max_tokens = settings['max_tokens']
     max_history_tokens = settings['max_history_tokens']
+    on_delta = on_delta if settings['stream'] else None
+
+    history, token_counts = await load_history(chat_id, model)
+    encoding = get_encoding(model)
 
     if not history:
         history.append({"role": "system", "content": prompt})
-        history_update(chat_id, history)
+        token_counts.append(count_tokens(history[0], encoding))
+        await history_append(chat_id, history, token_counts=token_counts)
 
     try:
         video_id = extract_video_id(video_link)
-        transcript_text = await get_video_transcript(video_id)
-        summary = await generate_video_summary(
-            transcript_text, questions, 
-            model, prompt, temperature, max_tokens,
-        )
+        summary_key = summary_cache_key(video_id, questions, model, prompt, temperature, max_tokens)
+        summary = await cache_get('summaries', summary_key, ttl=SUMMARY_CACHE_TTL)
+        if summary is None:
+            transcript_text = await get_video_transcript(video_id)
+            summary = await generate_video_summary(
+                transcript_text, questions, 
+                model, prompt, temperature, max_tokens,
+                on_delta,
+                settings['summary_chunk_tokens'], settings['summary_parallelism']
+            )
+            await cache_put('summaries', summary_key, summary,
+                            max_bytes=SUMMARY_CACHE_MAX_BYTES, ttl=SUMMARY_CACHE_TTL)
     except NoTranscriptFound:
         error_msg = f"No transcript found for video ID {video_id}."
         return error_msg
@@ -187,37 +683,35 @@ async def GPT_summarize(chat_id, video_link, questions):
     except NoTranscriptAvailable:
         error_msg = f"No transcript is available for video ID {video_id}."
         return error_msg
+    except asyncio.TimeoutError:
+        error_msg = f"Fetching the transcript for video ID {video_id} timed out."
+        return error_msg
     except Exception as e:
         error_msg = f"An error occurred: {e}"
         return error_msg
 
-    history.append({"role": "user", "content": video_link + " " + questions})
-    history.append({"role": "system", "content": "[FULL_VIDEO_TRANSCRIPT,OMITTED_IN_CHAT_HISTORY]"})
-    history.append({"role": "system", "content": "[YOUR_SUMMARY_OF_A_VIDEO_TRANSCRIPT]:"})
-    history.append({"role": "assistant", "content": summary})
-
-    history = await limit_history(history, model, max_history_tokens)
-    history_update(chat_id, history)
+    new_messages = [
+        {"role": "user", "content": video_link + " " + questions},
+        {"role": "system", "content": "[FULL_VIDEO_TRANSCRIPT,OMITTED_IN_CHAT_HISTORY]"},
+        {"role": "system", "content": "[YOUR_SUMMARY_OF_A_VIDEO_TRANSCRIPT]:"},
+        {"role": "assistant", "content": summary}
+    ]
+    new_token_counts = [count_tokens(message, encoding) for message in new_messages]
+    history.extend(new_messages)
+    token_counts.extend(new_token_counts)
+    history = await limit_history(history, model, max_history_tokens, token_counts)
+    await history_append(chat_id, new_messages, keep=len(history), token_counts=new_token_counts)
+    schedule_compaction(chat_id, settings, token_counts)
 
     return summary
 
 
-async def GPT_recognize(chat_id, base64_image, caption):
-    # Get the current history and settings
-    history = history_get(chat_id)
-    settings = load_settings(chat_id)
-
-    model = settings['model']
-    prompt = settings['prompt']
-    temperature = settings['temperature']
-    max_tokens = settings['max_tokens']
-    max_history_tokens = settings['max_history_tokens']
-
-    if not history: 
-        history.append({"role": "system", "content": prompt})
-        history_update(chat_id, history)
-
-    completion = await openai_client.chat.completions.create(
+## Vision call itself. The image is only sent along, it never ends up in the history
+async def recognize_image(
+        history, image_url, detail, caption,
+        model, temperature, max_tokens, on_delta=None):
+    return await create_completion(
+      on_delta,
       model=model,
       temperature=temperature,
       max_tokens=max_tokens,
@@ -229,22 +723,69 @@ async def GPT_recognize(chat_id, base64_image, caption):
             {
               "type": "image_url",
               "image_url": {
-                "url": f"data:image/jpeg;base64,{base64_image}",
+                "url": image_url,
+                "detail": detail,
               },
             },
           ],
         }
       ],
-    ) 
-    
-    response = completion.choices[0]
-    response_message = response.message.content
+    )
 
-    history.append({"role": "system", "content": "[PICTURE,OMITTED_IN_CHAT_HISTORY]"})
-    history.append({"role": "user", "content": caption})
-    history.append({"role": "system", "content": "[YOUR_DESCRIPTION_OF_AN_IMAGE]:"})
-    history.append({"role": "assistant", "content": response_message})
-    history = await limit_history(history, model, max_history_tokens)
-    history_update(chat_id, history)
 
-    return response
+## load_image(target_size, detail) - async callback returning the image bytes, target_size being
+## the side (px) the image needs: the longer one for low detail, else the shorter, see image_target_size()
+## image_key - stable id of the image (Telegram's file_unique_id). If set, results are cached,
+## so the same image with the same caption and settings skips both the download and Vision
+async def GPT_recognize(chat_id, load_image, caption, on_delta=None, image_key=None):
+    # Get the current history and settings
+    settings = await load_settings(chat_id)
+
+    model = settings['model']
+    prompt = settings['prompt']
+    temperature = settings['temperature']
+    max_tokens = settings['max_tokens']
+    max_history_tokens = settings['max_history_tokens']
+    on_delta = on_delta if settings['stream'] else None
+
+    history, token_counts = await load_history(chat_id, model)
+    encoding = get_encoding(model)
+
+    if not history:
+        history.append({"role": "system", "content": prompt})
+        token_counts.append(count_tokens(history[0], encoding))
+        await history_append(chat_id, history, token_counts=token_counts)
+
+    detail = settings['image_detail']
+    image_size = image_target_size(detail, settings['image_size'])
+
+    response_message = None
+    if image_key is not None:
+        vision_key = make_cache_key(image_key, caption, model, prompt, detail, image_size)
+        response_message = await cache_get('vision', vision_key, ttl=VISION_CACHE_TTL)
+    if response_message is None:
+        image_bytes = await load_image(image_size, detail)
+        image_url = await asyncio.to_thread(encode_image_url, image_bytes, detail, image_size)
+        del image_bytes
+        response_message = await recognize_image(
+            history, image_url, detail, caption,
+            model, temperature, max_tokens, on_delta
+        )
+        if image_key is not None:
+            await cache_put('vision', vision_key, response_message,
+                            max_bytes=VISION_CACHE_MAX_BYTES, ttl=VISION_CACHE_TTL)
+
+    new_messages = [
+        {"role": "system", "content": "[PICTURE,OMITTED_IN_CHAT_HISTORY]"},
+        {"role": "user", "content": caption},
+        {"role": "system", "content": "[YOUR_DESCRIPTION_OF_AN_IMAGE]:"},
+        {"role": "assistant", "content": response_message}
+    ]
+    new_token_counts = [count_tokens(message, encoding) for message in new_messages]
+    history.extend(new_messages)
+    token_counts.extend(new_token_counts)
+    history = await limit_history(history, model, max_history_tokens, token_counts)
+    await history_append(chat_id, new_messages, keep=len(history), token_counts=new_token_counts)
+    schedule_compaction(chat_id, settings, token_counts)
+
+    return response_message
@@ -8,9 +8,13 @@
 import os
 import sys
 import logging
-import base64
 import re
-from io import BytesIO
+import time
+import asyncio
+import functools
+import secrets
+from contextlib import nullcontext
+from urllib.parse import urlparse
 
 # Telegram
 from telegram import (
@@ -28,14 +32,23 @@ from telegram.ext import (
     filters
 )
 from telegram.error import (
-    BadRequest
+    BadRequest,
+    RetryAfter,
+    TelegramError
 )
+from telegram.request import HTTPXRequest
 
 # DB
 from y_DB import (
-    init_db, init_user,
-    key_get, key_set, key_remove,
-    chat_save, chat_load, chat_forget, chat_list,
+    init_db
+)
+from y_DB_async import (
+    shutdown as db_shutdown,
+    init_user,
+    compress_messages,
+    settings_get, key_set, key_remove,
+    chat_save, chat_load, chat_forget, chat_list, chat_search,
+    cache_stats, cache_clear,
 )
 
 # GPT
@@ -43,7 +56,27 @@ import openai
 from y_GPT import (
     GPT_query,
     GPT_summarize,
-    GPT_recognize
+    GPT_recognize,
+    ChatTurn,
+    load_settings,
+    prefetch_summary_transcript,
+    SETTINGS,
+    parse_setting
+)
+
+# Metrics
+import y_metrics
+from y_metrics import (
+    track,
+    tracked,
+    trace
+)
+import y_profiler
+
+# Multi-process mode
+from y_workers import (
+    WorkerPool,
+    setup_ingest
 )
 
 
@@ -62,18 +95,77 @@ if not all([BOT_OWNER, BOT_TOKEN, OPENAI_API_KEY]):
     print("Please populate y_secrets.env with BOT_OWNER, BOT_TOKEN, OPENAI_API_KEY") 
     sys.exit(1)
 
+# Optional: Telegram pushes updates to WEBHOOK_URL instead of the bot polling for them
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN") or "0.0.0.0"
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or 8443)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+# Optional: a self-hosted Bot API server, e.g. http://localhost:8081
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+# Optional: handle updates in this many worker processes, sharded by chat
+WORKERS = int(os.getenv("WORKERS") or 1)
+WORKER_INDEX = int(os.getenv("WORKER_INDEX") or 0)  # Set by y_workers
+# Optional: serve Prometheus metrics on METRICS_PORT (+ WORKER_INDEX in multi-process mode)
+METRICS_HOST = os.getenv("METRICS_HOST") or "127.0.0.1"
+METRICS_PORT = int(os.getenv("METRICS_PORT") or 0)
+# Optional: log a timeline of stages for every message that took longer than this many seconds
+SLOW_UPDATE_SECONDS = float(os.getenv("SLOW_UPDATE_SECONDS") or 0) or None
+
 
 ######################
 ## HELPER_FUNCTIONS ##
 ######################
 
 
-def load_allowed_users(filepath='y_allowed_users.txt'):
-    allowed_users = []
-    allowed_users.append(BOT_OWNER.lower())
-    with open(filepath, 'r') as file:
-        allowed_users = {line.strip().lower() for line in file if line.strip()}
-    return allowed_users
+ALLOWED_USERS_FILE = 'y_allowed_users.txt'
+
+## Allowlist is kept in memory and only re-read when the file's mtime changes
+## (e.g. someone edited it by hand). users_allow/users_disallow write through.
+_allowed_users = set()
+_allowed_users_mtime = None
+
+
+@tracked("allowed_users")
+def load_allowed_users(filepath=ALLOWED_USERS_FILE):
+    global _allowed_users, _allowed_users_mtime
+    try:
+        mtime = os.stat(filepath).st_mtime_ns
+    except FileNotFoundError:
+        return _allowed_users
+    if mtime != _allowed_users_mtime:
+        with open(filepath, 'r') as file:
+            _allowed_users = {line.strip().lower() for line in file if line.strip()}
+        _allowed_users_mtime = mtime
+    return _allowed_users
+
+
+def save_allowed_users(allowed_users, filepath=ALLOWED_USERS_FILE):
+    global _allowed_users, _allowed_users_mtime
+    with open(filepath, 'w') as file:
+        file.write(''.join(user + '\n' for user in sorted(allowed_users)))
+    _allowed_users = set(allowed_users)
+    _allowed_users_mtime = os.stat(filepath).st_mtime_ns
+
+
+## Telegram sends every photo in several sizes. Take the smallest one whose shorter side
+## (longer side for low detail, see image_target_size) still reaches target_size, or the largest one if none does
+def pick_photo_size(photo_sizes, target_size, detail):
+    side = max if detail == "low" else min
+    photo_sizes = sorted(photo_sizes, key=lambda photo: photo.width * photo.height)
+    for photo in photo_sizes:
+        if side(photo.width, photo.height) >= target_size:
+            return photo
+    return photo_sizes[-1]
+
+
+## Times a handler as handler.<name>; with SLOW_UPDATE_SECONDS set, slow ones log what they went through
+def traced(handler):
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args):
+        with trace(f"handler.{handler.__name__}", SLOW_UPDATE_SECONDS, f"in chat {update.effective_chat.id}"):
+            return await handler(update, context, *args)
+    return wrapper
+
 
 def touch_file(filepath):
     if not os.path.exists(filepath):
@@ -103,7 +195,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     allowed_users = load_allowed_users()
 
     if username == BOT_OWNER.lower() or username in allowed_users:
-        init_user(chat_id)
+        await init_user(chat_id)
         username = update.message.from_user.username.strip()
         await update.message.reply_text(
             f'👋 Hey @{username}! I am YAPPARI!👋\n\n\
@@ -143,12 +235,13 @@ You can also put your questions in caption.
 /chats_save <name> | /save <name> - save current chat
 /chats_load <name> | /load <name> - load some chat
 /chats_list | /ls - list all saved chats
+/chats_search <words> | /search <words> - find saved chats by name or by what was said in them
 
 ⚙️ Settings:
 /settings | /ss - list all settings
 /setting <setting> <value> | /s <s> <v> - set a setting
 Available settings:
-prompt, model, temperature, max_tokens, max_history_tokens
+{', '.join(SETTINGS)}
 
 😌 やっぱり!
         '''
@@ -159,6 +252,11 @@ prompt, model, temperature, max_tokens, max_history_tokens
 /users_allow <username> | /ua <username> - add a user to an allow list
 /users_disallow <username> | /ud <username>- remove user from an allow list
 /users_list | /u - show allowed_users.txt
+/cache - show cache hit rates
+/cache clear <what> - clear a cache (or all of them)
+/stats - latencies, errors and OpenAI token usage
+/profile <seconds> - profile the bot, get a flamegraph file
+/db_migrate - compress long messages stored by older versions, shrink the DB
             '''
             await update.message.reply_text(response_msg)
 
@@ -166,10 +264,13 @@ prompt, model, temperature, max_tokens, max_history_tokens
 ## HISTORY_MANAGEMENT ##
 ########################
 
+## These run non-blocking too, queued behind whatever the chat is already doing
 async def chats_forget(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.message.chat_id
     chat_name = ' '.join(context.args)
-    response_msg = chat_forget(chat_id=chat_id, chat_name=chat_name)
+    async with ChatTurn(chat_id) as turn:
+        await turn.wait()
+        response_msg = await chat_forget(chat_id=chat_id, chat_name=chat_name)
     await update.message.reply_text(response_msg)
 
 
@@ -177,7 +278,9 @@ async def chats_save(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     chat_id = update.message.chat_id
     chat_name = ' '.join(context.args)
     if chat_name:
-        chat_save(chat_id, chat_name)
+        async with ChatTurn(chat_id) as turn:
+            await turn.wait()
+            await chat_save(chat_id, chat_name)
         await update.message.reply_text(f"💾🔻 Chat history saved under the name '{chat_name}'.")
     else:
         await update.message.reply_text("❔ Please provide a name for the chat history.")
@@ -189,19 +292,35 @@ async def chats_load(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     if not chat_name:
         await update.message.reply_text("❔ Please provide the name of the saved chat history to load.")
     else:
-        response_msg = chat_load(chat_id=chat_id, chat_name=chat_name)
+        async with ChatTurn(chat_id) as turn:
+            await turn.wait()
+            response_msg = await chat_load(chat_id=chat_id, chat_name=chat_name)
         await update.message.reply_text(response_msg)
 
 
 async def chats_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.message.chat_id
-    saved_chats = chat_list(chat_id)
+    saved_chats = await chat_list(chat_id)
     if saved_chats:
         chats_list_str = '\n'.join(saved_chats)
         await update.message.reply_text(f"📜 Saved chats:\n{chats_list_str}")
     else:
         await update.message.reply_text("🤷 No saved chats found.")
 
+
+async def chats_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = update.message.chat_id
+    query = ' '.join(context.args)
+    if not query:
+        await update.message.reply_text("❔ Please provide words to search saved chats for.")
+        return
+    results = await chat_search(chat_id, query)
+    if results:
+        results_str = '\n\n'.join(f"💬 {chat_name}\n{snippet}".strip() for chat_name, snippet in results)
+        await update.message.reply_text(f"🔎 Saved chats for \"{query}\":\n\n{results_str}")
+    else:
+        await update.message.reply_text(f"❔ No chats found for \"{query}\"")
+
 ######################
 ## USERS_MANAGEMENT ##
 ##   (owner only)   ##
@@ -211,12 +330,9 @@ async def users_allow(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     if update.message.from_user.username.lower() == BOT_OWNER.lower():
         username = ' '.join(context.args).strip().lower()
         if username and username != BOT_OWNER.lower():
-            filepath = 'y_allowed_users.txt'
-            touch_file(filepath)  # Ensure the file exists
-            allowed_users = load_allowed_users(filepath)
+            allowed_users = load_allowed_users()
             if username not in allowed_users:
-                with open(filepath, 'a') as file:
-                    file.write(username + '\n')
+                save_allowed_users(allowed_users | {username})
                 await update.message.reply_text(f"✅ User '{username}' added to allowed users.")
             else:
                 await update.message.reply_text(f"❌ User '{username}' is already in the allowed users list.")
@@ -228,13 +344,9 @@ async def users_disallow(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if update.message.from_user.username.lower() == BOT_OWNER.lower():
         username = ' '.join(context.args).strip().lower()
         if username and username != BOT_OWNER.lower():
-            filepath = 'y_allowed_users.txt'
-            touch_file(filepath)  # Ensure the file exists
-            allowed_users = load_allowed_users(filepath)
+            allowed_users = load_allowed_users()
             if username in allowed_users:
-                allowed_users.remove(username)
-                with open(filepath, 'w') as file:
-                    file.write('\n'.join(allowed_users) + '\n')
+                save_allowed_users(allowed_users - {username})
                 await update.message.reply_text(f"✅ User '{username}' removed from allowed users.")
             else:
                 await update.message.reply_text(f"❌ User '{username}' is not in the allowed users list.")
@@ -248,40 +360,211 @@ async def users_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         allowed_users_list = '\n'.join(allowed_users)
         await update.message.reply_text(f"👀 Allowed users:\n{allowed_users_list}")
 
+async def cache(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.from_user.username.lower() == BOT_OWNER.lower():
+        if context.args and context.args[0].lower() == "clear":
+            namespace = context.args[1] if len(context.args) > 1 else None
+            await cache_clear(namespace)
+            await update.message.reply_text(f"✨ Cache '{namespace}' cleared!" if namespace else "✨ All caches cleared!")
+            return
+
+        stats = await cache_stats()
+        if not stats:
+            await update.message.reply_text("🤷 Caches are empty.")
+            return
+        lines = []
+        for namespace, s in sorted(stats.items()):
+            lookups = s['hits'] + s['misses']
+            hit_rate = f"{s['hits'] / lookups:.0%}" if lookups else "-"
+            lines.append(f"{namespace}: {s['entries']} entries, {s['bytes'] / 1024:.0f} KB, "
+                         f"hit rate {hit_rate} ({s['hits']}/{lookups})")
+        await update.message.reply_text("🗃 Caches:\n" + "\n".join(lines))
+
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.from_user.username.lower() == BOT_OWNER.lower():
+        title = f"📊 Stats of worker {WORKER_INDEX}:" if WORKERS > 1 else "📊 Stats:"
+        await update.message.reply_text(f"{title}\n{y_metrics.summary()}")
+
+
+## Every other DB call waits until it's done
+async def db_migrate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.from_user.username.lower() == BOT_OWNER.lower():
+        await update.message.reply_text("🗜 Compressing messages...")
+        compressed, size_before, size_after = await compress_messages()
+        await update.message.reply_text(f"✨ {compressed} messages compressed, "
+                                        f"DB size {size_before / 2**20:.1f} MB -> {size_after / 2**20:.1f} MB")
+
+
+## Runs non-blocking, the bot keeps working (and gets profiled) meanwhile
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.from_user.username.lower() == BOT_OWNER.lower():
+        try:
+            seconds = min(float(context.args[0]) if context.args else 10, y_profiler.MAX_SECONDS)
+        except ValueError:
+            await update.message.reply_text("❌ Usage: /profile <seconds>")
+            return
+
+        await update.message.reply_text(f"🔬 Profiling for {seconds:g}s...")
+        try:
+            stacks, elapsed = await y_profiler.profile(seconds)
+        except RuntimeError as e:
+            await update.message.reply_text(f"❌ {e}")
+            return
+        worker = f"_worker{WORKER_INDEX}" if WORKERS > 1 else ""
+        await update.message.reply_document(
+            document=stacks.encode(),
+            filename=f"profile{worker}_{time.strftime('%Y%m%d_%H%M%S')}.collapsed",
+            caption=f"🔥 {elapsed:.1f}s of samples, collapsed stacks. "
+                    f"Open in speedscope.app or run flamegraph.pl on it."
+        )
+
 ###################
 ## GPT_FUNCTIONS ##
 ###################
 
 SPLIT_MESSAGE_LENGTH = 4096 # Telegram's limit for 1 message
+STREAM_EDIT_INTERVAL = 1.5  # Seconds between edits of a streamed message, Telegram rate-limits edits
+
+
+## Shows a streamed completion by editing the "Thinking..." placeholder in place.
+## Edits are throttled to STREAM_EDIT_INTERVAL; once the text outgrows SPLIT_MESSAGE_LENGTH
+## the current message is finalized and the rest continues in a new one.
+## Markdown is only applied in finish(), half-generated markdown is usually broken.
+class StreamingReply:
+    def __init__(self, update: Update, placeholder):
+        self.update = update
+        self.messages = [placeholder]
+        self.text = ""
+        self.shown = placeholder.text
+        self.next_edit = 0.0
+
+    @property
+    def streamed(self):
+        return self.text != ""
+
+    async def on_delta(self, delta):
+        self.text += delta
+        if time.monotonic() >= self.next_edit:
+            await self.flush()
+
+    ## Returns the seconds Telegram wants us to wait if it flood-controlled us, else None
+    async def flush(self):
+        chunks = [self.text[i:i + SPLIT_MESSAGE_LENGTH] for i in range(0, len(self.text), SPLIT_MESSAGE_LENGTH)]
+        try:
+            while len(self.messages) < len(chunks):
+                await self._edit(chunks[len(self.messages) - 1])
+                self.messages.append(await self.update.message.reply_text(chunks[len(self.messages)]))
+                self.shown = chunks[len(self.messages) - 1]
+            if chunks:
+                await self._edit(chunks[-1])
+            self.next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if hasattr(retry_after, 'total_seconds'):
+                retry_after = retry_after.total_seconds()
+            self.next_edit = time.monotonic() + retry_after
+            return retry_after
+        except TelegramError as e:
+            # Never let a failed edit kill the completion, the next flush catches up
+            logger.warning(f"Streaming edit failed: {e}")
+            self.next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+
+    ## No next flush to catch up here, so flood control is waited out until all of the text is shown
+    async def finish(self, text):
+        self.text = text
+        while (retry_after := await self.flush()) is not None:
+            await asyncio.sleep(retry_after)
+        for i, message in enumerate(self.messages):
+            try:
+                await message.edit_text(text[i * SPLIT_MESSAGE_LENGTH:(i + 1) * SPLIT_MESSAGE_LENGTH], parse_mode=ParseMode.MARKDOWN)
+            except BadRequest:
+                pass  # Improperly closed markdown (or nothing changed), keep the plain text
+            except TelegramError as e:
+                logger.warning(f"Markdown edit failed, keeping the plain text: {e}")
+
+    ## Edits the last message, unless it already shows the text ("message is not modified" is an error)
+    async def _edit(self, text):
+        if text and text != self.shown:
+            await self.messages[-1].edit_text(text)
+            self.shown = text
+
+
+async def send_response(update: Update, response_msg, reply=None):
+    if reply is not None and reply.streamed:
+        await reply.finish(response_msg)
+        return
+    for i in range(0, len(response_msg), SPLIT_MESSAGE_LENGTH):
+        try:
+            await update.message.reply_text(response_msg[i:i + SPLIT_MESSAGE_LENGTH], parse_mode=ParseMode.MARKDOWN)
+        except BadRequest:
+            await update.message.reply_text("⚠️ GPT generated a message with improperly closed markdown. Telegram doesn't like that.\n\nMarkdown is disabled for next message.")
+            await update.message.reply_text(response_msg[i:i + SPLIT_MESSAGE_LENGTH], parse_mode=ParseMode.HTML)
 
 
+_pending_queries = {}  # chat_id: texts collected during the chat's coalescing window
+
+
+@traced
 async def gpt_logic(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     youtube_pattern = r'(?:v=|\/)([0-9A-Za-z_-]{11}).*'
     message_text = update.message.text.strip()
     if not re.search(youtube_pattern, message_text.split()[0]):
-        await gpt_query(update, context)
+        await gpt_coalesce(update, context)
     else:
         await gpt_summarize(update, context)
 
 
-async def gpt_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+## With 'coalesce_ms' set, the first message opens a window and everything the user sends
+## during it is merged into one user turn and one GPT_query
+## The turn is taken before anything is awaited (even the settings), so a photo, a link or
+## a command sent right after the text waits for it
+async def gpt_coalesce(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.message.chat_id
     username = update.message.from_user.username.lower()
     allowed_users = load_allowed_users()
 
+    if username == BOT_OWNER.lower() or username in allowed_users:
+        async with ChatTurn(chat_id) as turn:
+            settings = await load_settings(chat_id)
+            if not settings['coalesce_ms']:
+                await gpt_query(update, context, turn=turn)
+                return
+
+            pending = _pending_queries.get(chat_id)
+            if pending is not None:
+                pending.append(update.message.text)
+                return  # Answered by the message that opened the window, our turn isn't needed
+            _pending_queries[chat_id] = [update.message.text]
+            try:
+                await asyncio.sleep(settings['coalesce_ms'] / 1000)
+            finally:
+                texts = _pending_queries.pop(chat_id)
+            await gpt_query(update, context, "\n".join(texts), turn)
+
+
+## Every handler that touches the chat's history takes a ChatTurn first thing,
+## so quick consecutive messages in one chat are answered in order
+## turn - the caller's ChatTurn, if it took one already
+async def gpt_query(update: Update, context: ContextTypes.DEFAULT_TYPE, query=None, turn=None) -> None:
+    chat_id = update.message.chat_id
+    query = query or update.message.text
+    username = update.message.from_user.username.lower()
+    allowed_users = load_allowed_users()
+
     if username == BOT_OWNER.lower() or username in allowed_users: 
-        await update.message.reply_text("Thinking... ⏳️")
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-        try:
-            response_msg = await GPT_query(chat_id, update.message.text)
-            for i in range(0, len(response_msg), SPLIT_MESSAGE_LENGTH):
-                try:
-                    await update.message.reply_text(response_msg[i:i + SPLIT_MESSAGE_LENGTH], parse_mode=ParseMode.MARKDOWN)
-                except BadRequest:
-                    await update.message.reply_text("⚠️ GPT generated a message with improperly closed markdown. Telegram doesn't like that.\n\nMarkdown is disabled for next message.")
-                    await update.message.reply_text(response_msg[i:i + SPLIT_MESSAGE_LENGTH], parse_mode=ParseMode.HTML)
-        except (openai.APIError, openai.RateLimitError):
-            await update.message.reply_text("❌ OpenAI error. Try again? (also, better clear history)")
+        async with ChatTurn(chat_id) if turn is None else nullcontext(turn) as turn:
+            placeholder = await update.message.reply_text("Thinking... ⏳️")
+            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
+            reply = StreamingReply(update, placeholder)
+            await turn.wait()
+            try:
+                response_msg = await GPT_query(chat_id, query, reply.on_delta)
+                await send_response(update, response_msg, reply)
+            except openai.RateLimitError:
+                await update.message.reply_text("❌ OpenAI is busy with too many requests. Try again in a minute?")
+            except openai.APIError:
+                await update.message.reply_text("❌ OpenAI error. Try again? (also, better clear history)")
 
 
 async def gpt_summarize(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -290,51 +573,59 @@ async def gpt_summarize(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     allowed_users = load_allowed_users()
 
     if username == BOT_OWNER.lower() or username in allowed_users:
-        await update.message.reply_text("Analyzing video transcript... ⏳️")
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-        message = update.message.text.strip().split(maxsplit=1)
-        video_link = message[0]
-        if len(message) > 1: 
-            questions = message[1]
-        else:
-            questions = ""
+        async with ChatTurn(chat_id) as turn:
+            message = update.message.text.strip().split(maxsplit=1)
+            video_link = message[0]
+            if len(message) > 1: 
+                questions = message[1]
+            else:
+                questions = ""
 
-        try:
-            response_msg = await GPT_summarize(chat_id, video_link, questions)
-            for i in range(0, len(response_msg), SPLIT_MESSAGE_LENGTH):
-                await update.message.reply_text(response_msg[i:i + SPLIT_MESSAGE_LENGTH], parse_mode=ParseMode.MARKDOWN)
-        except (openai.APIError, openai.RateLimitError):
-            await update.message.reply_text("❌ OpenAI error. Try again? (also, better clear history)")
+            # Start fetching the transcript while we're still acknowledging the message
+            await prefetch_summary_transcript(chat_id, video_link, questions)
+
+            placeholder = await update.message.reply_text("Analyzing video transcript... ⏳️")
+            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
+
+            reply = StreamingReply(update, placeholder)
+            await turn.wait()
+            try:
+                response_msg = await GPT_summarize(chat_id, video_link, questions, reply.on_delta)
+                await send_response(update, response_msg, reply)
+            except openai.RateLimitError:
+                await update.message.reply_text("❌ OpenAI is busy with too many requests. Try again in a minute?")
+            except openai.APIError:
+                await update.message.reply_text("❌ OpenAI error. Try again? (also, better clear history)")
 
 
+@traced
 async def gpt_recognize(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
     username = update.message.from_user.username.lower()
     allowed_users = load_allowed_users()
 
     if username == BOT_OWNER.lower() or username in allowed_users:
-        await update.message.reply_text("Analyzing image... ⏳️")
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-
-        # Download image directly into memory
-        photo_id = update.message.photo[-1]
-        bio = BytesIO()
-        file = await photo_id.get_file()
-        await file.download_to_memory(out=bio)
-        bio.seek(0)
-        
-        # Convert to base64 to pass to OpenAI Vision
-        base64_image = base64.b64encode(bio.read()).decode('utf-8')
-        
-        if update.message.caption:
-            caption = update.message.caption
-        else:
-            caption = "What's in this image?"
-        
-        response = await GPT_recognize(chat_id, base64_image, caption)
-        response_msg = response.message.content
-        for i in range(0, len(response_msg), SPLIT_MESSAGE_LENGTH):
-            await update.message.reply_text(response_msg[i:i + SPLIT_MESSAGE_LENGTH], parse_mode=ParseMode.MARKDOWN)
+        async with ChatTurn(chat_id) as turn:
+            placeholder = await update.message.reply_text("Analyzing image... ⏳️")
+            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
+
+            # Download the right-sized image directly into memory, once GPT_recognize knows the size
+            photo_sizes = update.message.photo
+
+            async def load_image(target_size, detail):
+                file = await pick_photo_size(photo_sizes, target_size, detail).get_file()
+                return await file.download_as_bytearray()
+
+            if update.message.caption:
+                caption = update.message.caption
+            else:
+                caption = "What's in this image?"
+
+            reply = StreamingReply(update, placeholder)
+            await turn.wait()
+            response_msg = await GPT_recognize(chat_id, load_image, caption, reply.on_delta,
+                                               image_key=photo_sizes[-1].file_unique_id)
+            await send_response(update, response_msg, reply)
 
 ##############
 ## SETTINGS ##
@@ -352,15 +643,20 @@ async def settings_update(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             return
 
         key, value = message[1], message[2]
-        if key in ['model', 'prompt', 'temperature', 'max_tokens', 'max_history_tokens']:
+        if key in SETTINGS:
             if value == "default":
-                key_remove(chat_id, key)
+                await key_remove(chat_id, key)
                 await update.message.reply_text(f"✅ Setting '{key}' is back to default.")
             else:
-                key_set(chat_id, key, value)
+                try:
+                    parse_setting(key, value)
+                except ValueError as e:
+                    await update.message.reply_text(f"❌ Invalid value for '{key}': {e}")
+                    return
+                await key_set(chat_id, key, value)
                 await update.message.reply_text(f"✅ Setting '{key}' updated to '{value}'.")
         else:
-            await update.message.reply_text("❌ Invalid key.\n\nValid keys are: model, prompt, temperature, max_tokens, max_history_tokens.")
+            await update.message.reply_text(f"❌ Invalid key.\n\nValid keys are: {', '.join(SETTINGS)}.")
 
 
 async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -369,8 +665,8 @@ async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     allowed_users = load_allowed_users()
 
     if username == BOT_OWNER.lower() or username in allowed_users:
-        settings_keys = ['model', 'prompt', 'temperature', 'max_tokens', 'max_history_tokens']
-        settings = {key: key_get(chat_id, key) or "default" for key in settings_keys}
+        stored_settings = await settings_get(chat_id)
+        settings = {key: stored_settings.get(key) or "default" for key in SETTINGS}
         
         settings_message = "\n".join([f"{key}: {value}" for key, value in settings.items()])
         await update.message.reply_text(f"⚙️ Current settings:\n{settings_message}")
@@ -381,24 +677,51 @@ async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 ##########
 
 
-def main() -> None:
+## Times every Bot API call as telegram.<method> (file downloads as telegram.download),
+## except long polling for updates
+class TrackedRequest(HTTPXRequest):
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = "download" if "/file/bot" in url else url.rsplit('/', 1)[-1]
+        with track(f"telegram.{api_method}"):
+            return await super().do_request(url, method, *args, **kwargs)
 
-    init_db()
-    touch_file('y_allowed_users.txt')
 
-    application = Application.builder().token(BOT_TOKEN).build()
+async def post_init(application: Application) -> None:
+    if METRICS_PORT:
+        await y_metrics.serve(METRICS_HOST, METRICS_PORT + WORKER_INDEX)
+
+
+async def post_shutdown(application: Application) -> None:
+    db_shutdown()
+
+
+def application_builder():
+    builder = Application.builder().token(BOT_TOKEN).request(TrackedRequest())
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL.rstrip('/')}/bot")
+        builder = builder.base_file_url(f"{TELEGRAM_API_URL.rstrip('/')}/file/bot")
+    return builder
+
+
+def build_application() -> Application:
+    application = application_builder().post_init(post_init).post_shutdown(post_shutdown).build()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler(["help", "h"],  help))
 
-    application.add_handler(CommandHandler(["chats_forget", "f"], chats_forget))
-    application.add_handler(CommandHandler(["chats_save", "save"], chats_save))
-    application.add_handler(CommandHandler(["chats_load", "load"], chats_load))
+    application.add_handler(CommandHandler(["chats_forget", "f"], chats_forget, block=False))
+    application.add_handler(CommandHandler(["chats_save", "save"], chats_save, block=False))
+    application.add_handler(CommandHandler(["chats_load", "load"], chats_load, block=False))
     application.add_handler(CommandHandler(["chats_list", "ls"], chats_list))
+    application.add_handler(CommandHandler(["chats_search", "search"], chats_search))
 
     application.add_handler(CommandHandler(["users_allow", "ua"], users_allow))
     application.add_handler(CommandHandler(["users_disallow", "ud"], users_disallow))
     application.add_handler(CommandHandler(["users_list", "u"], users_list))
+    application.add_handler(CommandHandler("cache", cache))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("profile", profile, block=False))
+    application.add_handler(CommandHandler("db_migrate", db_migrate))
 
     application.add_handler(CommandHandler(["setting", "s"], settings_update))
     application.add_handler(CommandHandler(["settings", "ss"], settings))
@@ -406,7 +729,31 @@ def main() -> None:
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, gpt_logic, block=False))
     application.add_handler(MessageHandler(filters.PHOTO & ~filters.COMMAND, gpt_recognize, block=False))
 
-    application.run_polling()
+    return application
+
+
+def main() -> None:
+
+    init_db()
+    touch_file(ALLOWED_USERS_FILE)
+
+    if WORKERS > 1:
+        # This process only receives updates, the handlers run in the workers
+        application = setup_ingest(application_builder().build(), WorkerPool(WORKERS))
+    else:
+        application = build_application()
+
+    if WEBHOOK_URL:
+        # Telegram sends WEBHOOK_SECRET in a header with every update, anything without it is dropped
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=urlparse(WEBHOOK_URL).path.lstrip("/"),
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET
+        )
+    else:
+        application.run_polling()
 
 
 if __name__ == "__main__":
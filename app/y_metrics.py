@@ -0,0 +1,237 @@
+"""
+In-process metrics: latency histograms, in-flight gauges, error and token counters.
+
+Hot paths are wrapped with track("stage") (a context manager) or @tracked("stage"),
+which records how long they took, how many run right now and what they raised.
+Everything is updated from the event loop thread only, so there are no locks.
+
+Optionally served in Prometheus text format by serve(host, port) on /metrics,
+and summarized for humans by summary() (the owner's /stats command).
+
+Handlers wrapped with trace() also collect the stages they went through, and log
+that timeline when they took longer than a threshold.
+"""
+
+import asyncio
+import bisect
+import contextvars
+import functools
+import logging
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_metrics = []
+_servers = []
+_started = time.time()
+_timeline = contextvars.ContextVar("timeline", default=None)  # [(stage, start, seconds, error)] of a trace()
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self.values = {}
+        _metrics.append(self)
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        for label_values, value in sorted(self.values.items()):
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self.values = {}    # label values -> [bucket counts..., +Inf count, sum]
+        _metrics.append(self)
+
+    def observe(self, value, *label_values):
+        counts = self.values.get(label_values)
+        if counts is None:
+            counts = self.values[label_values] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def count(self, label_values):
+        return sum(self.values[label_values][:-1])
+
+    ## Upper bound of the bucket the q-th quantile falls into
+    def quantile(self, q, label_values):
+        counts = self.values[label_values]
+        rank, seen = q * self.count(label_values), 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        for label_values, counts in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = _format_labels(self.labels, label_values, f'le="{bound}"')
+                yield f"{self.name}_bucket{le} {cumulative}"
+            labels = _format_labels(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {counts[-1]}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+STAGE_SECONDS = Histogram("yappari_stage_seconds", "Time spent in a stage", ("stage",))
+IN_FLIGHT = Gauge("yappari_in_flight", "Calls of a stage running right now", ("stage",))
+ERRORS = Counter("yappari_errors_total", "Exceptions raised by a stage", ("stage", "error"))
+OPENAI_TOKENS = Counter("yappari_openai_tokens_total", "Tokens reported by OpenAI usage", ("model", "kind"))
+
+
+@contextmanager
+def track(stage):
+    IN_FLIGHT.inc(stage)
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = type(e).__name__
+        ERRORS.inc(stage, error)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        IN_FLIGHT.dec(stage)
+        STAGE_SECONDS.observe(elapsed, stage)
+        timeline = _timeline.get()
+        if timeline is not None:
+            timeline.append((stage, start, elapsed, error))
+
+
+## Decorator version of track(), for plain and async functions
+def tracked(stage):
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with track(stage):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with track(stage):
+                    return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+## track() that also collects the stages run inside it (tasks started from it included)
+## and logs them when it took at least slow_after seconds
+@contextmanager
+def trace(stage, slow_after=None, description=""):
+    if slow_after is None:
+        with track(stage):
+            yield
+        return
+
+    timeline = []
+    token = _timeline.set(timeline)
+    start = time.perf_counter()
+    try:
+        with track(stage):
+            yield
+    finally:
+        _timeline.reset(token)
+        elapsed = time.perf_counter() - start
+        if elapsed >= slow_after:
+            lines = [f"Slow {stage} {description}: {elapsed:.2f}s"]
+            for name, stage_start, seconds, error in sorted(timeline[:-1], key=lambda entry: entry[1]):
+                line = f"  +{stage_start - start:7.3f}s {name} {seconds:.3f}s"
+                lines.append(f"{line} ({error})" if error else line)
+            logger.warning("\n".join(lines))
+
+
+## usage - completion.usage (or the last chunk's, when streaming), may be None
+def record_usage(model, usage):
+    if usage is None:
+        return
+    OPENAI_TOKENS.inc(model, "prompt", amount=usage.prompt_tokens or 0)
+    OPENAI_TOKENS.inc(model, "completion", amount=usage.completion_tokens or 0)
+    details = getattr(usage, "prompt_tokens_details", None)
+    if details is not None and getattr(details, "cached_tokens", None):
+        OPENAI_TOKENS.inc(model, "cached", amount=details.cached_tokens)
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+def summary():
+    lines = [f"Up {(time.time() - _started) / 3600:.1f}h"]
+    for (stage,), counts in sorted(STAGE_SECONDS.values.items()):
+        count = STAGE_SECONDS.count((stage,))
+        errors = sum(value for (error_stage, _), value in ERRORS.values.items() if error_stage == stage)
+        line = (f"{stage}: {count} calls, avg {counts[-1] / count * 1000:.0f}ms, "
+                f"p50 ≤{STAGE_SECONDS.quantile(0.5, (stage,)) * 1000:.0f}ms, "
+                f"p95 ≤{STAGE_SECONDS.quantile(0.95, (stage,)) * 1000:.0f}ms")
+        if IN_FLIGHT.values.get((stage,)):
+            line += f", {IN_FLIGHT.values[(stage,)]} running"
+        if errors:
+            line += f", {errors} errors"
+        lines.append(line)
+    for (model, kind), value in sorted(OPENAI_TOKENS.values.items()):
+        lines.append(f"{model} {kind} tokens: {value}")
+    return "\n".join(lines)
+
+
+async def _handle(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():
+            pass  # Headers
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host, port):
+    server = await asyncio.start_server(_handle, host, port)
+    _servers.append(server)
+    logger.info(f"Metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,110 @@
+"""
+Sampling profiler for the running bot, behind the owner's /profile command.
+
+While it runs, a thread records every INTERVAL seconds the stack of every other
+thread (the event loop running the handlers, the DB thread, the executors) from
+sys._current_frames(). That shows where CPU time goes, but a handler waiting for
+OpenAI or Telegram is just the loop sitting in select(), so every TASK_INTERVAL
+the loop also records the await chain of each asyncio task - where handlers spend
+wall time.
+
+The result is in the collapsed format ("root;outer;...;inner count" per line) read
+by flamegraph.pl, speedscope.app and inferno.
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+INTERVAL = 0.005
+TASK_INTERVAL = 0.05
+MAX_SECONDS = 300
+
+_running = False
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _collapse(frames):
+    return ";".join(_frame_name(frame) for frame in frames)
+
+
+def _thread_stack(frame):
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    return reversed(frames)
+
+
+## Task.get_stack() only has the outermost frame of a suspended coroutine, so follow
+## what each coroutine (or generator-based awaitable) awaits, down to the future at the bottom
+def _await_stack(coro):
+    frames = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break  # A future, or a finished coroutine
+        frames.append(frame)
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return frames
+
+
+## Runs in the sampling thread, records into its own Counter only
+def _sample_threads(stacks, stop, loop, task_sampler):
+    me = threading.get_ident()
+    every = max(1, round(TASK_INTERVAL / INTERVAL))
+    samples = 0
+    while not stop.wait(INTERVAL):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident != me:
+                stacks[f"{names.get(ident, ident)};{_collapse(_thread_stack(frame))}"] += 1
+        samples += 1
+        if samples % every == 0:
+            loop.call_soon_threadsafe(task_sampler)
+
+
+## Profiles the whole process for seconds (up to MAX_SECONDS), returns (collapsed stacks, seconds it took)
+async def profile(seconds):
+    global _running
+    if _running:
+        raise RuntimeError("A profile is already running")
+    _running = True
+
+    loop = asyncio.get_running_loop()
+    me = asyncio.current_task()
+    thread_stacks, task_stacks = Counter(), Counter()
+
+    # Runs on the loop, records into its own Counter only
+    def sample_tasks():
+        for task in asyncio.all_tasks(loop):
+            frames = _await_stack(task.get_coro())
+            if task is not me and frames:
+                task_stacks[f"asyncio tasks;{_collapse(frames)}"] += 1
+
+    stop = threading.Event()
+    sampler = threading.Thread(
+        target=_sample_threads,
+        args=(thread_stacks, stop, loop, sample_tasks),
+        name="y_profiler",
+        daemon=True
+    )
+    start = time.perf_counter()
+    sampler.start()
+    try:
+        await asyncio.sleep(min(seconds, MAX_SECONDS))
+    finally:
+        stop.set()
+        sampler.join()
+        _running = False
+
+    stacks = thread_stacks + task_stacks
+    collapsed = "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+    return collapsed, time.perf_counter() - start
@@ -0,0 +1,189 @@
+"""
+Client-side rate limiting for OpenAI calls.
+
+Every completion goes through one shared RateLimiter:
+    - two token buckets, requests per minute and tokens per minute,
+      refilled continuously and resized from the x-ratelimit-* response headers.
+      The API enforces its per-minute limits over shorter periods too, so a bucket
+      holds only BURST_SECONDS worth of its limit instead of a whole minute
+    - retries of 429s and transient errors with exponential backoff and full jitter,
+      honouring retry-after. A 429 pauses all calls; retries of errors are also
+      limited by a shared budget so a struggling API doesn't get hit with a retry storm
+"""
+
+import asyncio
+import random
+import re
+import time
+import logging
+
+import openai
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RPM = 500
+DEFAULT_TPM = 200000
+BURST_SECONDS = 10
+
+MAX_RETRIES = 4             # Per call
+BACKOFF_BASE = 0.5          # Seconds, doubled every retry
+BACKOFF_MAX = 20
+RETRY_BUDGET = 10           # Retries that can be spent at once across all calls...
+RETRY_BUDGET_PER_MINUTE = 10  # ...and how fast they come back
+
+
+class TokenBucket:
+    def __init__(self, capacity, per_minute):
+        self.capacity = capacity
+        self.rate = per_minute / 60
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    ## Seconds until `amount` is available, 0 if it's there already
+    def wait_time(self, amount):
+        self._refill()
+        amount = min(amount, self.capacity)
+        return max(0, (amount - self.tokens) / self.rate)
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+    def try_take(self, amount=1):
+        if self.wait_time(amount) > 0:
+            return False
+        self.take(amount)
+        return True
+
+    def resize(self, capacity, per_minute, remaining=None):
+        self._refill()
+        self.capacity = capacity
+        self.rate = per_minute / 60
+        self.tokens = min(self.tokens, capacity)
+        if remaining is not None:
+            self.tokens = min(self.tokens, remaining)
+
+
+## "1s", "6m0s", "120ms", "1h2m3.5s" -> seconds
+def parse_reset(value):
+    if not value:
+        return None
+    total = 0.0
+    for amount, unit in re.findall(r'([\d.]+)(ms|h|m|s)', value):
+        total += float(amount) * {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}[unit]
+    return total
+
+
+## How much of a per-minute limit can go out at once
+def burst_capacity(per_minute, burst_seconds):
+    return max(1, per_minute * burst_seconds / 60)
+
+
+class RateLimiter:
+    ## share - the part of the account's limits this process gets, when several processes share them
+    def __init__(self, rpm=DEFAULT_RPM, tpm=DEFAULT_TPM, burst_seconds=BURST_SECONDS, share=1.0):
+        self.burst_seconds = burst_seconds
+        self.share = share
+        rpm, tpm = rpm * share, tpm * share
+        self.requests = TokenBucket(burst_capacity(rpm, burst_seconds), rpm)
+        self.tokens = TokenBucket(burst_capacity(tpm, burst_seconds), tpm)
+        self.retries = TokenBucket(RETRY_BUDGET, RETRY_BUDGET_PER_MINUTE)
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+        self.stats = {'requests': 0, 'retries': 0, 'rate_limited': 0, 'waited': 0.0}
+
+    ## Waits until one request of estimated_tokens fits into both budgets
+    async def acquire(self, estimated_tokens):
+        async with self.lock:  # First come, first served
+            while True:
+                wait = max(
+                    self.paused_until - time.monotonic(),
+                    self.requests.wait_time(1),
+                    self.tokens.wait_time(estimated_tokens)
+                )
+                if wait <= 0:
+                    self.requests.take(1)
+                    self.tokens.take(estimated_tokens)
+                    return
+                self.stats['waited'] += wait
+                await asyncio.sleep(wait)
+
+    ## The limits the API reports are per minute, remaining is what's left right now
+    def update_from_headers(self, headers):
+        try:
+            for bucket, kind in ((self.requests, 'requests'), (self.tokens, 'tokens')):
+                limit = headers.get(f'x-ratelimit-limit-{kind}')
+                if not limit:
+                    continue
+                limit = int(limit) * self.share
+                remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+                bucket.resize(
+                    burst_capacity(limit, self.burst_seconds),
+                    limit,
+                    int(remaining) * self.share if remaining else None
+                )
+        except ValueError:
+            logger.warning(f"Unparsable rate limit headers: {dict(headers)}")
+
+    ## Nobody sends anything for `seconds`
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def is_retryable(e):
+    if isinstance(e, openai.RateLimitError):
+        # Out of credits won't fix itself
+        return getattr(e, 'code', None) != 'insufficient_quota'
+    return isinstance(e, (openai.APIConnectionError, openai.InternalServerError))
+
+
+def retry_after(e):
+    response = getattr(e, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    if headers.get('retry-after-ms'):
+        return float(headers['retry-after-ms']) / 1000
+    if headers.get('retry-after'):
+        try:
+            return float(headers['retry-after'])
+        except ValueError:
+            return None
+    return parse_reset(headers.get('x-ratelimit-reset-requests') or headers.get('x-ratelimit-reset-tokens'))
+
+
+## Runs call() (which makes one raw OpenAI request and returns its raw response)
+## under the limiter, retrying what's worth retrying
+async def call_with_retries(limiter, call, estimated_tokens):
+    attempt = 0
+    while True:
+        await limiter.acquire(estimated_tokens)
+        limiter.stats['requests'] += 1
+        try:
+            raw_response = await call()
+        except openai.APIError as e:
+            rate_limited = isinstance(e, openai.RateLimitError)
+            if rate_limited:
+                limiter.stats['rate_limited'] += 1
+            if not is_retryable(e) or attempt >= MAX_RETRIES:
+                raise
+            # 429s pause everyone anyway, the budget is for errors
+            if not rate_limited and not limiter.retries.try_take():
+                raise
+            delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+            server_delay = retry_after(e)
+            if server_delay is not None:
+                delay = max(delay, server_delay)
+            if rate_limited:
+                limiter.pause(delay)
+            attempt += 1
+            limiter.stats['retries'] += 1
+            logger.info(f"OpenAI {type(e).__name__}, retry {attempt}/{MAX_RETRIES} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+            continue
+        limiter.update_from_headers(raw_response.headers)
+        return raw_response
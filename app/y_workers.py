@@ -0,0 +1,167 @@
+"""
+Multi-process mode: one ingest process, WORKERS worker processes.
+
+The ingest process is the only one talking to Telegram for updates (polling or
+webhook). It doesn't run any handlers, it hands every update to the worker that
+owns its chat, chat_id % WORKERS, so messages of one chat are still handled in
+order by one process, and that chat's settings cache and history writes stay there.
+
+Workers are full bots (y_bot.build_application) fed from a multiprocessing queue.
+A worker that dies is started again with a fresh queue (a killed process can leave
+the old one locked), so updates it had taken or that were still waiting for it are lost.
+On shutdown every worker gets SHUTDOWN, finishes what it has and exits.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue as queue_module
+import signal
+import time
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+logger = logging.getLogger(__name__)
+
+SHUTDOWN = None
+NOTHING = object()
+SUPERVISE_INTERVAL = 1      # Seconds between checks that all workers are alive
+RESTART_DELAY = 1           # Doubled for every crash in a row, up to RESTART_DELAY_MAX
+RESTART_DELAY_MAX = 60
+STABLE_AFTER = 60           # A worker that lived this long is no longer crash looping
+SHUTDOWN_TIMEOUT = 30
+
+
+def shard(chat_id, workers):
+    return (chat_id or 0) % workers
+
+
+class WorkerPool:
+    def __init__(self, workers):
+        self.workers = workers
+        # Fresh interpreters, nothing (DB connections, event loop) inherited from the ingest process
+        self.context = multiprocessing.get_context("spawn")
+        self.queues = [self.context.Queue() for _ in range(workers)]
+        self.processes = [None] * workers
+        self.started_at = [0.0] * workers
+        self.crashes = [0] * workers
+        self.stopping = False
+        self.supervisor = None
+
+    def start(self):
+        for index in range(self.workers):
+            self._spawn(index)
+        self.supervisor = asyncio.get_running_loop().create_task(self.supervise())
+
+    def _spawn(self, index):
+        process = self.context.Process(
+            target=worker_main,
+            args=(index, self.queues[index]),
+            name=f"y_worker_{index}"
+        )
+        process.start()
+        self.processes[index] = process
+        self.started_at[index] = time.monotonic()
+
+    async def dispatch(self, update: Update, context) -> None:
+        chat_id = update.effective_chat.id if update.effective_chat else 0
+        self.queues[shard(chat_id, self.workers)].put(update.to_dict())
+
+    ## Restarts workers that died, backing off if one keeps dying
+    async def supervise(self):
+        while not self.stopping:
+            await asyncio.sleep(SUPERVISE_INTERVAL)
+            for index, process in enumerate(self.processes):
+                if self.stopping or process.is_alive():
+                    continue
+                if time.monotonic() - self.started_at[index] > STABLE_AFTER:
+                    self.crashes[index] = 0
+                delay = min(RESTART_DELAY_MAX, RESTART_DELAY * 2 ** self.crashes[index])
+                self.crashes[index] += 1
+                logger.error(f"Worker {index} exited with {process.exitcode}, restarting in {delay}s")
+                old_queue, self.queues[index] = self.queues[index], self.context.Queue()
+                old_queue.cancel_join_thread()
+                old_queue.close()
+                await asyncio.sleep(delay)
+                if not self.stopping:
+                    self._spawn(index)
+
+    def stop(self):
+        self.stopping = True
+        if self.supervisor:
+            self.supervisor.cancel()
+        for queue in self.queues:
+            queue.put(SHUTDOWN)
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for index, process in enumerate(self.processes):
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"Worker {index} did not finish in {SHUTDOWN_TIMEOUT}s, killing it")
+                process.kill()
+                process.join()
+
+
+## Turns an application built without handlers into the ingest side of the pool
+def setup_ingest(application, pool):
+    application.add_handler(TypeHandler(Update, pool.dispatch))
+
+    post_init, post_stop = application.post_init, application.post_stop
+
+    async def start_pool(application):
+        pool.start()
+        if post_init:
+            await post_init(application)
+
+    # By now the ingest process has stopped taking updates, so workers get everything before SHUTDOWN
+    async def stop_pool(application):
+        pool.stop()
+        if post_stop:
+            await post_stop(application)
+
+    application.post_init = start_pool
+    application.post_stop = stop_pool
+    return application
+
+
+## Entry point of a worker process
+def worker_main(index, queue):
+    # Ctrl+C and systemd's SIGTERM are for the ingest process, it tells workers when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    os.environ["WORKER_INDEX"] = str(index)
+
+    import y_bot
+    asyncio.run(run_worker(y_bot.build_application(), queue))
+
+
+## Doesn't block forever, so a failing worker can still exit (and be restarted)
+def next_update(queue):
+    try:
+        return queue.get(timeout=1)
+    except queue_module.Empty:
+        return NOTHING
+
+
+async def run_worker(application, queue):
+    loop = asyncio.get_running_loop()
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    try:
+        while True:
+            data = await loop.run_in_executor(None, next_update, queue)
+            if data is NOTHING:
+                continue
+            if data is SHUTDOWN:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        # Finish everything already taken before stopping
+        await application.update_queue.join()
+    finally:
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Event-loop latency under concurrent chats: sync y_DB vs y_DB_async.
+
+Every simulated chat does what one GPT_query does against the DB
+(settings reads, history_get, history_update) in a loop, while a probe task
+sleeps 1ms at a time and records how late it wakes up. That lateness is
+what every other chat served by the bot would feel.
+
+    python bench/bench_event_loop.py --chats 50 --turns 20 --history 200
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+import y_DB
+import y_DB_async
+
+SETTINGS_KEYS = ['model', 'prompt', 'temperature', 'max_tokens', 'max_history_tokens']
+
+
+def make_history(size):
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"message {i} " + "lorem ipsum " * 40}
+        for i in range(size)
+    ]
+
+
+async def chat_sync(chat_id, turns, history):
+    for _ in range(turns):
+        for key in SETTINGS_KEYS:
+            y_DB.key_get(chat_id, key)
+        y_DB.history_get(chat_id)
+        y_DB.history_update(chat_id, history)
+        await asyncio.sleep(0)
+
+
+async def chat_async(chat_id, turns, history):
+    for _ in range(turns):
+        for key in SETTINGS_KEYS:
+            await y_DB_async.key_get(chat_id, key)
+        await y_DB_async.history_get(chat_id)
+        await y_DB_async.history_update(chat_id, history)
+
+
+async def probe(lags, stop):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append((time.perf_counter() - start - 0.001) * 1000)
+
+
+async def run(chat_fn, chats, turns, history):
+    lags = []
+    stop = asyncio.Event()
+    probe_task = asyncio.create_task(probe(lags, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(chat_fn(chat_id, turns, history) for chat_id in range(chats)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await probe_task
+    return elapsed, lags
+
+
+def report(name, elapsed, lags):
+    lags = sorted(lags)
+    q = statistics.quantiles(lags, n=100, method="inclusive") if len(lags) > 1 else [lags[0]] * 99
+    print(f"{name:>6}: total {elapsed:7.2f}s | loop lag ms "
+          f"p50 {q[49]:7.2f}  p95 {q[94]:7.2f}  p99 {q[98]:7.2f}  max {lags[-1]:7.2f}  (samples {len(lags)})")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--history", type=int, default=200, help="messages per chat history")
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix="y_bench_"))
+    y_DB.init_db()
+    for chat_id in range(args.chats):
+        y_DB.init_user(chat_id)
+    history = make_history(args.history)
+
+    report("sync", *asyncio.run(run(chat_sync, args.chats, args.turns, history)))
+    report("async", *asyncio.run(run(chat_async, args.chats, args.turns, history)))
+    y_DB_async.shutdown()
+
+
+if __name__ == "__main__":
+    main()
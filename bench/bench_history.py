@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Microbenchmarks of the per-message history work, at various history sizes.
+
+    limit_history   - from scratch (tokenizing every message) and with cached token counts
+    y_DB            - history_get, history_get_rows, history_append (one turn, trimmed),
+                      history_update (full rewrite), chat_save + chat_load, settings reads
+
+Every number is the mean time of one call, in milliseconds.
+
+    python bench/bench_history.py --sizes 10,100,1000,5000
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+MODEL = "gpt-4o-mini"
+
+
+def make_history(size):
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"message {i} " + "lorem ipsum " * 40}
+        for i in range(size)
+    ]
+
+
+## Mean seconds per call, calling func for at least min_time
+def measure(func, min_time):
+    calls, start = 0, time.perf_counter()
+    while True:
+        func()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / calls
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10,100,1000,5000", help="messages per history")
+    parser.add_argument("--min-time", type=float, default=0.3, help="seconds per measurement")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    os.chdir(tempfile.mkdtemp(prefix="y_bench_"))
+    os.environ.setdefault("OPENAI_API_KEY", "fake")
+    import y_DB
+    import y_GPT
+
+    y_DB.init_db()
+    encoding = y_GPT.get_encoding(MODEL)
+    loop = asyncio.new_event_loop()
+
+    results = {}
+    for size in sizes:
+        chat_id = size
+        y_DB.init_user(chat_id)
+        history = make_history(size)
+        token_counts = [y_GPT.count_tokens(message, encoding) for message in history]
+        budget = sum(token_counts) // 2
+        turn = [{"role": "user", "content": "one more question"}, {"role": "assistant", "content": "one more answer"}]
+        y_DB.history_update(chat_id, history)
+
+        def limit(counts):
+            counts = None if counts is None else list(counts)
+            loop.run_until_complete(y_GPT.limit_history(list(history), MODEL, budget, counts))
+
+        def save_load():
+            y_DB.chat_save(chat_id, "bench")
+            y_DB.chat_load(chat_id, "bench")
+
+        results[size] = {
+            "limit_history (tokenize)": measure(lambda: limit(None), args.min_time),
+            "limit_history (counts)": measure(lambda: limit(token_counts), args.min_time),
+            "history_get": measure(lambda: y_DB.history_get(chat_id), args.min_time),
+            "history_get_rows": measure(lambda: y_DB.history_get_rows(chat_id), args.min_time),
+            "history_append": measure(lambda: y_DB.history_append(chat_id, turn, keep=size), args.min_time),
+            "history_update": measure(lambda: y_DB.history_update(chat_id, history), args.min_time),
+            "chat_save + chat_load": measure(save_load, args.min_time),
+            "settings_get": measure(lambda: y_DB.settings_get(chat_id), args.min_time),
+            "key_get": measure(lambda: y_DB.key_get(chat_id, "model"), args.min_time),
+        }
+
+    names = list(results[sizes[0]])
+    print(f"{'ms per call':>26}" + "".join(f"{size:>10}" for size in sizes))
+    for name in names:
+        print(f"{name:>26}" + "".join(f"{results[size][name] * 1000:10.3f}" for size in sizes))
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
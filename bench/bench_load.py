@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+"""
+Load test: many concurrent chats through the real handlers.
+
+Runs y_bot's application in this process against bench/fake_telegram.py and
+bench/fake_openai.py, with YouTube replaced by a synthetic transcript after
+--youtube-latency. Every chat sends --messages messages one after another, each
+one a text query (gpt_logic -> gpt_query), a video link (gpt_logic -> gpt_summarize)
+or a photo (gpt_recognize), picked by --mix. A message is done when its full
+answer is in the chat.
+
+Reports p50/p95/p99 latency per kind, messages per second, and where the time
+went, per stage:
+    db         - y_DB_async calls (queueing for the DB thread included)
+    tokenize   - count_tokens, split_by_tokens
+    image      - encode_image_url
+    openai     - create_completion, rate limiting and streaming included
+    telegram   - Bot API requests
+    loop lag   - how late a 10ms sleep wakes up, i.e. how busy the event loop is;
+                 the async stages above include it
+The fake servers run as threads of this process, so for numbers closer to
+production start fake_openai.py separately and pass --openai-url.
+
+    python bench/bench_load.py --chats 50 --messages 10 --mix query=8,summary=1,image=1
+"""
+
+import argparse
+import asyncio
+import functools
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from io import BytesIO
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "app"))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_openai import start_fake_openai
+from fake_telegram import start_fake_telegram, make_text_update, make_photo_update
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+PHOTO_SIZES = [(90, 51), (320, 180), (800, 450), (1280, 720)]
+PLACEHOLDERS = ("Thinking", "Analyzing")
+
+
+class Stages:
+    def __init__(self):
+        self.times = defaultdict(list)
+
+    def wrap(self, owner, name, stage):
+        func = getattr(owner, name)
+        times = self.times[stage]
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    times.append(time.perf_counter() - start)
+        else:
+            @functools.wraps(func)
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    times.append(time.perf_counter() - start)
+
+        setattr(owner, name, timed)
+
+    def report(self):
+        print(f"{'stage':>10} {'calls':>7} {'total s':>8} {'mean ms':>8} {'p95 ms':>8}")
+        for stage, times in self.times.items():
+            if times:
+                print(f"{stage:>10} {len(times):7d} {sum(times):8.2f} "
+                      f"{statistics.mean(times) * 1000:8.2f} {percentile(times, 95) * 1000:8.2f}")
+
+
+async def probe_loop_lag(lags, stop):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.01)
+        lags.append(time.perf_counter() - start - 0.01)
+
+
+def percentile(values, q):
+    if len(values) < 2:
+        return values[0]
+    return statistics.quantiles(values, n=100)[q - 1]
+
+
+def synthetic_transcript(words, seed):
+    vocabulary = ["so", "today", "we", "are", "going", "to", "talk", "about", "video", "really",
+                  "important", "thing", "and", "then", "next", "part", "you", "know", "like", "this"]
+    rng = random.Random(seed)
+    return " ".join(rng.choice(vocabulary) for _ in range(words))
+
+
+def synthetic_image(width, height):
+    if Image is None:
+        return os.urandom(width * height // 10)
+    buffer = BytesIO()
+    Image.effect_noise((width, height), 64).convert("RGB").save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def parse_mix(mix):
+    kinds, weights = [], []
+    for part in mix.split(","):
+        kind, weight = part.split("=")
+        kinds.append(kind)
+        weights.append(float(weight))
+    return kinds, weights
+
+
+## Resolves a chat's pending message once its answer is complete.
+## Streamed answers end with an edit of the placeholder, others are sent as new messages
+class ReplyWatcher:
+    def __init__(self, loop, final_word):
+        self.loop = loop
+        self.final_word = final_word
+        self.waiting = {}
+
+    def expect(self, chat_id):
+        future = self.loop.create_future()
+        self.waiting[chat_id] = [None, future]
+        return future
+
+    def on_sent(self, sent):
+        self.loop.call_soon_threadsafe(self._check, sent)
+
+    def _check(self, sent):
+        sent_at, method, chat_id, message_id, text = sent
+        waiting = self.waiting.get(chat_id)
+        if waiting is None:
+            return
+        placeholder_id, future = waiting
+        if placeholder_id is None and method == "sendMessage" and text.startswith(PLACEHOLDERS):
+            waiting[0] = message_id
+        elif self.final_word in text and (message_id == placeholder_id or method == "sendMessage"):
+            del self.waiting[chat_id]
+            future.set_result(sent_at)
+
+
+async def run_chat(application, telegram, watcher, images, chat_id, args, kinds, weights, latencies, counter):
+    from telegram import Update
+
+    rng = random.Random(chat_id)
+    for i in range(args.messages):
+        kind = rng.choices(kinds, weights)[0]
+        n = next(counter)
+        if kind == "query":
+            data = make_text_update(n, chat_id, f"Question {i}: " + "tell me more " * rng.randint(1, 30))
+        elif kind == "summary":
+            data = make_text_update(n, chat_id, f"https://youtu.be/{n:011d} what is it about?")
+        else:
+            for width, height in PHOTO_SIZES:
+                telegram.add_file(f"p{n}_{width}", images[(width, height)])
+            data = make_photo_update(n, chat_id, [(f"p{n}_{width}", width, height) for width, height in PHOTO_SIZES])
+
+        done = watcher.expect(chat_id)
+        start = time.perf_counter()
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        try:
+            latencies[kind].append(await asyncio.wait_for(done, args.timeout) - start)
+        except asyncio.TimeoutError:
+            watcher.waiting.pop(chat_id, None)
+            latencies["failed"].append(args.timeout)
+
+
+async def run(args):
+    telegram, telegram_url = start_fake_telegram()
+    openai_url = args.openai_url
+    if not openai_url:
+        _, openai_url = start_fake_openai(
+            latency=args.latency,
+            latency_per_1k_prompt=args.latency_per_1k_prompt,
+            latency_per_output_token=args.latency_per_output_token,
+            output_tokens=args.output_tokens,
+        )
+    os.environ.update(
+        BOT_OWNER="bench",
+        BOT_TOKEN="1:bench",
+        OPENAI_API_KEY="fake",
+        OPENAI_BASE_URL=openai_url,
+        OPENAI_RPM=str(10 ** 6),
+        OPENAI_TPM=str(10 ** 9),
+        TELEGRAM_API_URL=telegram_url,
+    )
+    os.chdir(tempfile.mkdtemp(prefix="y_bench_"))
+
+    import y_bot
+    import y_GPT
+    import y_DB_async
+    from telegram.request import HTTPXRequest
+
+    def fake_fetch_video_transcript(video_id, lang='en'):
+        time.sleep(args.youtube_latency)
+        return synthetic_transcript(args.transcript_words, video_id)
+
+    y_GPT.fetch_video_transcript = fake_fetch_video_transcript
+
+    stages = Stages()
+    stages.wrap(y_DB_async, "run_db", "db")
+    stages.wrap(y_GPT, "count_tokens", "tokenize")
+    stages.wrap(y_GPT, "split_by_tokens", "tokenize")
+    stages.wrap(y_GPT, "encode_image_url", "image")
+    stages.wrap(y_GPT, "create_completion", "openai")
+    stages.wrap(HTTPXRequest, "do_request", "telegram")
+
+    y_bot.init_db()
+    y_bot.touch_file(y_bot.ALLOWED_USERS_FILE)
+    application = y_bot.build_application()
+    await application.initialize()
+    await application.start()
+
+    loop = asyncio.get_running_loop()
+    watcher = ReplyWatcher(loop, f"word{args.output_tokens - 1}")
+    telegram.on_sent = watcher.on_sent
+    kinds, weights = parse_mix(args.mix)
+    images = {size: synthetic_image(*size) for size in PHOTO_SIZES}
+    latencies = defaultdict(list)
+    counter = iter(range(1, 10 ** 9))
+
+    lags, stop = [], asyncio.Event()
+    probe = asyncio.create_task(probe_loop_lag(lags, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        run_chat(application, telegram, watcher, images, 1000 + n, args, kinds, weights, latencies, counter)
+        for n in range(args.chats)
+    ))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await probe
+
+    await application.stop()
+    await application.shutdown()
+    y_DB_async.shutdown()
+
+    failed = latencies.pop("failed", [])
+    total = sum(len(values) for values in latencies.values())
+    print(f"{total} messages from {args.chats} chats in {elapsed:.2f}s, {total / elapsed:.1f} messages/s")
+    if failed:
+        print(f"{len(failed)} messages got no answer within {args.timeout}s")
+    print(f"{'kind':>10} {'count':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for kind, values in sorted(latencies.items()) + [("all", sum(latencies.values(), []))]:
+        if not values:
+            continue  # Every message of the kind timed out, see above
+        print(f"{kind:>10} {len(values):7d} {percentile(values, 50) * 1000:8.1f} "
+              f"{percentile(values, 95) * 1000:8.1f} {percentile(values, 99) * 1000:8.1f}")
+    print()
+    stages.report()
+    if lags:
+        print(f"{'loop lag':>10} {len(lags):7d} {sum(lags):8.2f} {statistics.mean(lags) * 1000:8.2f} "
+              f"{percentile(lags, 95) * 1000:8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=10, help="per chat")
+    parser.add_argument("--mix", default="query=8,summary=1,image=1")
+    parser.add_argument("--latency", type=float, default=0.3, help="fake OpenAI base latency")
+    parser.add_argument("--latency-per-1k-prompt", type=float, default=0.02)
+    parser.add_argument("--latency-per-output-token", type=float, default=0.002)
+    parser.add_argument("--output-tokens", type=int, default=100, help="must match the server's with --openai-url")
+    parser.add_argument("--openai-url", help="a fake_openai.py started separately, e.g. http://127.0.0.1:8081/v1")
+    parser.add_argument("--youtube-latency", type=float, default=0.5)
+    parser.add_argument("--transcript-words", type=int, default=3000)
+    parser.add_argument("--timeout", type=float, default=120, help="per message")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Burst of completions against a rate-limited API.
+
+Fires --requests concurrent create_completion() calls at bench/fake_openai.py
+limited to --rate-limit requests per minute:
+    openai retries - no limiter, the openai client's own 2 retries (how it was before)
+    adaptive       - limiter with no idea of the limit, learning it from the response headers
+    configured     - limiter with OPENAI_RPM set to the server's limit
+Reports wall time, failed calls, 429s the server handed out and retries spent.
+
+    python bench/bench_ratelimit.py --requests 60 --rate-limit 600
+"""
+
+import argparse
+import asyncio
+import functools
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "app"))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_openai import start_fake_openai
+
+
+async def plain_completion(client, semaphore, **kwargs):
+    async with semaphore:
+        completion = await client.chat.completions.create(**kwargs)
+        return completion.choices[0].message.content
+
+
+async def burst(complete, requests):
+    messages = [{"role": "user", "content": "Hello"}]
+    start = time.perf_counter()
+    results = await asyncio.gather(*(
+        complete(model="gpt-4o-mini", messages=messages, max_tokens=20)
+        for _ in range(requests)
+    ), return_exceptions=True)
+    failed = sum(isinstance(result, Exception) for result in results)
+    return time.perf_counter() - start, failed
+
+
+def report(name, server, counters, elapsed, failed, requests, limiter=None):
+    rejected, errors = counters
+    line = (f"{name:>14}: {elapsed:6.2f}s, {requests - failed}/{requests} ok, "
+            f"{server.rejected - rejected} x 429, {server.errors - errors} x 500")
+    if limiter:
+        line += f", {limiter.stats['retries']} retries, {limiter.stats['waited']:.1f}s waited in limiter"
+    print(line)
+
+
+async def run_scenarios(y_GPT, server, rate_limit, burst_seconds, requests):
+    from openai import AsyncOpenAI
+    from y_ratelimit import RateLimiter
+
+    counters = server.rejected, server.errors
+    complete = functools.partial(plain_completion, AsyncOpenAI(max_retries=2), asyncio.Semaphore(y_GPT.MAX_OPENAI_CALLS))
+    elapsed, failed = await burst(complete, requests)
+    report("openai retries", server, counters, elapsed, failed, requests)
+
+    # The server enforces its limit per second, so the configured limiter may only burst a second's worth
+    scenarios = [
+        ("adaptive", RateLimiter(rpm=10 ** 6, tpm=10 ** 9, burst_seconds=burst_seconds)),
+        ("configured", RateLimiter(rpm=rate_limit, tpm=10 ** 9, burst_seconds=burst_seconds)),
+    ]
+    for name, limiter in scenarios:
+        await asyncio.sleep(1)  # Fresh window on the server
+        y_GPT.rate_limiter = limiter
+        counters = server.rejected, server.errors
+        elapsed, failed = await burst(y_GPT.create_completion, requests)
+        report(name, server, counters, elapsed, failed, requests, limiter)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=60)
+    parser.add_argument("--rate-limit", type=int, default=600, help="requests per minute the server accepts")
+    parser.add_argument("--burst-seconds", type=float, default=1.0)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server, base_url = start_fake_openai(
+        latency=args.latency,
+        latency_per_output_token=0.0,
+        rate_limit=args.rate_limit,
+        rate_window=1.0,
+        error_rate=args.error_rate,
+    )
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ.setdefault("OPENAI_API_KEY", "fake")
+    import y_GPT
+
+    # One event loop for everything, y_GPT's semaphore is bound to the first loop that waits on it
+    asyncio.run(run_scenarios(y_GPT, server, args.rate_limit, args.burst_seconds, args.requests))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Message storage formats: DB size and chat_save / chat_load time.
+
+For every text format in y_DB (plain, as older versions stored everything, and
+zlib-compressed long messages) fills a fresh DB with --chats saved chats of
+--messages messages each, then loads and re-saves every one of them. Reports the
+DB size and the mean time of chat_save and chat_load, and how long /db_migrate
+takes on the plain DB.
+
+Message text is drawn from a Zipf-distributed vocabulary, which compresses about
+as well as real English; video summaries are --summary-words long.
+
+    python bench/bench_storage.py --chats 2000 --messages 20
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+import y_DB
+
+FORMATS = {
+    "plain": y_DB.TEXT_FORMAT_PLAIN,
+    "zlib": y_DB.TEXT_FORMAT_ZLIB,
+}
+
+
+def make_text(rng, vocabulary, weights, words):
+    return " ".join(rng.choices(vocabulary, weights, k=words))
+
+
+def make_history(rng, vocabulary, weights, messages, summary_words):
+    history = [{"role": "system", "content": "You are a helpful assistant."}]
+    for i in range(messages // 2):
+        if rng.random() < 0.2:
+            history.append({"role": "user", "content": f"https://youtu.be/{rng.randrange(10 ** 11):011d}"})
+            history.append({"role": "assistant", "content": make_text(rng, vocabulary, weights, summary_words)})
+        else:
+            history.append({"role": "user", "content": make_text(rng, vocabulary, weights, rng.randint(5, 40))})
+            history.append({"role": "assistant", "content": make_text(rng, vocabulary, weights, rng.randint(50, 300))})
+    return history
+
+
+def db_size():
+    y_DB.get_connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return os.path.getsize(y_DB.DB_PATH)
+
+
+def fill(histories, args):
+    save_times = []
+    for n, history in enumerate(histories):
+        chat_id = n % args.users
+        y_DB.history_update(chat_id, history)
+        start = time.perf_counter()
+        y_DB.chat_save(chat_id, f"chat {n}")
+        save_times.append(time.perf_counter() - start)
+    return save_times
+
+
+def load_all(histories, args):
+    load_times = []
+    for n in range(len(histories)):
+        chat_id = n % args.users
+        start = time.perf_counter()
+        y_DB.chat_load(chat_id, f"chat {n}")
+        load_times.append(time.perf_counter() - start)
+        y_DB.chat_save(chat_id, f"chat {n}")
+    return load_times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=2000, help="saved chats in the DB")
+    parser.add_argument("--messages", type=int, default=20, help="per saved chat")
+    parser.add_argument("--users", type=int, default=20, help="saved chats are spread over this many chat_ids")
+    parser.add_argument("--summary-words", type=int, default=400)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    vocabulary = [f"word{i}" for i in range(5000)]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    histories = [make_history(rng, vocabulary, weights, args.messages, args.summary_words) for _ in range(args.chats)]
+
+    os.chdir(tempfile.mkdtemp(prefix="y_bench_"))
+    print(f"{'format':>14} {'DB MB':>8} {'save ms':>8} {'load ms':>8}")
+    for name, version in FORMATS.items():
+        y_DB.close_connection()
+        y_DB.DB_PATH = f"{version}.db"
+        y_DB.TEXT_FORMAT = version
+        y_DB.init_db()
+        save_times = fill(histories, args)
+        size = db_size()
+        load_times = load_all(histories, args)
+        print(f"{name:>14} {size / 2 ** 20:8.2f} {sum(save_times) / len(save_times) * 1000:8.3f} "
+              f"{sum(load_times) / len(load_times) * 1000:8.3f}")
+
+    y_DB.close_connection()
+    y_DB.DB_PATH = f"{y_DB.TEXT_FORMAT_PLAIN}.db"
+    y_DB.TEXT_FORMAT = y_DB.TEXT_FORMAT_ZLIB
+    start = time.perf_counter()
+    compressed, size_before, size_after = y_DB.compress_messages()
+    print(f"\ncompressing the plain DB: {compressed} messages in {time.perf_counter() - start:.2f}s, "
+          f"{size_before / 2 ** 20:.2f} MB -> {size_after / 2 ** 20:.2f} MB")
+    y_DB.close_connection()
+
+
+if __name__ == "__main__":
+    main()
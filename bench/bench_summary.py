@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Single-pass vs map-reduce video summary on a synthetic long transcript.
+
+Runs generate_video_summary() against bench/fake_openai.py, whose latency grows
+with prompt size, once with the whole transcript in one call and once chunked
+with concurrent chunk calls.
+
+    python bench/bench_summary.py --words 60000 --chunk-tokens 12000 --parallelism 4
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "app"))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_openai import start_fake_openai
+
+
+def synthetic_transcript(words):
+    vocabulary = ["so", "today", "we", "are", "going", "to", "talk", "about", "video", "really",
+                  "important", "thing", "and", "then", "next", "part", "you", "know", "like", "this"]
+    rng = random.Random(42)
+    return " ".join(rng.choice(vocabulary) for _ in range(words))
+
+
+async def timed(coro):
+    start = time.perf_counter()
+    await coro
+    return time.perf_counter() - start
+
+
+## Both runs on one loop: y_GPT's client keeps its connections (and its semaphore) bound to the first one
+async def run(y_GPT, server, transcript, args):
+    common = dict(questions="", model="gpt-4o-mini", prompt="You are a helpful assistant",
+                  temperature=0.7, max_tokens=300)
+
+    single = await timed(y_GPT.generate_video_summary(transcript, **common))
+    requests = server.requests
+    print(f"single pass: {single:6.2f}s ({requests} request)")
+
+    chunked = await timed(y_GPT.generate_video_summary(
+        transcript, **common, chunk_tokens=args.chunk_tokens, parallelism=args.parallelism))
+    print(f" map-reduce: {chunked:6.2f}s ({server.requests - requests} requests, "
+          f"chunk_tokens={args.chunk_tokens}, parallelism={args.parallelism})")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--words", type=int, default=60000)
+    parser.add_argument("--chunk-tokens", type=int, default=12000)
+    parser.add_argument("--parallelism", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--latency-per-1k-prompt", type=float, default=0.1)
+    parser.add_argument("--latency-per-output-token", type=float, default=0.005)
+    args = parser.parse_args()
+
+    server, base_url = start_fake_openai(
+        latency=args.latency,
+        latency_per_1k_prompt=args.latency_per_1k_prompt,
+        latency_per_output_token=args.latency_per_output_token,
+    )
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ.setdefault("OPENAI_API_KEY", "fake")
+    import y_GPT
+
+    transcript = synthetic_transcript(args.words)
+    tokens = len(y_GPT.get_encoding("gpt-4o-mini").encode(transcript))
+    print(f"transcript: {args.words} words, {tokens} tokens")
+
+    asyncio.run(run(y_GPT, server, transcript, args))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
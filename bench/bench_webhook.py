@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""
+End-to-end message latency of the bot in webhook vs polling mode.
+
+Runs app/y_bot.py as a subprocess against bench/fake_telegram.py and
+bench/fake_openai.py. Every simulated chat sends a message, waits for the reply
+to be complete, and sends the next one. Measured per message, from the moment the
+update is handed to Telegram (the webhook POST, or the queue getUpdates reads from):
+    ack   - the "Thinking..." placeholder is sent
+    reply - the full answer is in the chat
+In webhook mode it also checks that an update without the secret token is refused.
+--workers N runs the bot in multi-process mode.
+
+    python bench/bench_webhook.py --chats 20 --messages 5 --mode both
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BOT_SCRIPT = os.path.join(BENCH_DIR, "..", "app", "y_bot.py")
+sys.path.insert(0, BENCH_DIR)
+
+from fake_openai import start_fake_openai
+from fake_telegram import start_fake_telegram, make_text_update
+
+SECRET = "bench-secret"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def post_update(url, update, secret=SECRET):
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(update).encode(),
+        headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+## Waits until the bot sends something for chat_id after `since` that matches `predicate`,
+## returns (time it was sent, message_id)
+def wait_sent(telegram, chat_id, since, predicate, timeout=30):
+    deadline = time.monotonic() + timeout
+    with telegram.condition:
+        while True:
+            for sent_at, method, sent_chat, message_id, text in telegram.sent:
+                if sent_chat == chat_id and sent_at >= since and predicate(message_id, text):
+                    return sent_at, message_id
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"chat {chat_id}: no reply in {timeout}s")
+            telegram.condition.wait(remaining)
+
+
+def start_bot(mode, telegram_url, openai_url, workdir, workers):
+    env = dict(
+        os.environ,
+        WORKERS=str(workers),
+        BOT_OWNER="bench",
+        BOT_TOKEN="1:bench",
+        OPENAI_API_KEY="fake",
+        OPENAI_BASE_URL=openai_url,
+        OPENAI_TPM=str(10 ** 9),  # Measure Telegram, not our own OpenAI pacing
+        TELEGRAM_API_URL=telegram_url,
+    )
+    webhook_url = None
+    if mode == "webhook":
+        port = free_port()
+        webhook_url = f"http://127.0.0.1:{port}/telegram"
+        env.update(WEBHOOK_URL=webhook_url, WEBHOOK_LISTEN="127.0.0.1", WEBHOOK_PORT=str(port), WEBHOOK_SECRET=SECRET)
+    process = subprocess.Popen([sys.executable, os.path.abspath(BOT_SCRIPT)], cwd=workdir, env=env)
+    return process, webhook_url
+
+
+def listening(url):
+    host, port = url.split("/")[2].split(":")
+    try:
+        socket.create_connection((host, int(port)), timeout=1).close()
+        return True
+    except OSError:
+        return False
+
+
+def wait_ready(telegram, mode, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"bot exited with {process.returncode}")
+        if mode == "webhook" and telegram.webhook_url and listening(telegram.webhook_url):
+            return
+        if mode == "polling" and telegram.polls:
+            return
+        time.sleep(0.05)
+    raise TimeoutError("bot did not start")
+
+
+def run_mode(mode, args, telegram, telegram_url, openai_url):
+    acks, replies, posts = [], [], []
+    final_word = f"word{args.output_tokens - 1}"
+    update_ids = iter(range(1, 10 ** 9))
+    lock = threading.Lock()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        process, webhook_url = start_bot(mode, telegram_url, openai_url, workdir, args.workers)
+        try:
+            wait_ready(telegram, mode, process)
+
+            if webhook_url:
+                status = post_update(webhook_url, make_text_update(0, 1, "no secret"), secret="wrong")
+                print(f"{mode}: update with a wrong secret token -> HTTP {status}")
+
+            def chat(chat_id, messages, acks, replies, posts):
+                for i in range(messages):
+                    with lock:
+                        update = make_text_update(next(update_ids), chat_id, f"message {i}")
+                    start = time.perf_counter()
+                    if webhook_url:
+                        status = post_update(webhook_url, update)
+                        posts.append(time.perf_counter() - start)
+                        assert status == 200, status
+                    else:
+                        telegram.push_update(update)
+                    acked, placeholder_id = wait_sent(
+                        telegram, chat_id, start, lambda message_id, text: text.startswith("Thinking"))
+                    replied, _ = wait_sent(
+                        telegram, chat_id, start, lambda message_id, text: message_id == placeholder_id and final_word in text)
+                    acks.append(acked - start)
+                    replies.append(replied - start)
+
+            def all_chats(messages, acks, replies, posts):
+                threads = [
+                    threading.Thread(target=chat, args=(1000 + n, messages, acks, replies, posts))
+                    for n in range(args.chats)
+                ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+            # One unmeasured message per chat first, so worker processes are up and connections are open
+            all_chats(1, [], [], [])
+            start = time.perf_counter()
+            all_chats(args.messages, acks, replies, posts)
+            elapsed = time.perf_counter() - start
+        finally:
+            process.terminate()
+            process.wait(10)
+
+    def ms(values, q):
+        return statistics.quantiles(values, n=100)[q - 1] * 1000 if len(values) > 1 else values[0] * 1000
+
+    print(f"{mode}: {len(replies)} messages in {elapsed:.2f}s")
+    print(f"    ack   p50 {ms(acks, 50):7.1f}ms  p95 {ms(acks, 95):7.1f}ms")
+    print(f"    reply p50 {ms(replies, 50):7.1f}ms  p95 {ms(replies, 95):7.1f}ms")
+    if posts:
+        print(f"    POST  p50 {ms(posts, 50):7.1f}ms  p95 {ms(posts, 95):7.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["webhook", "polling", "both"], default="both")
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.2, help="fake OpenAI latency")
+    parser.add_argument("--output-tokens", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    telegram, telegram_url = start_fake_telegram()
+    _, openai_url = start_fake_openai(latency=args.latency, output_tokens=args.output_tokens)
+
+    for mode in (["webhook", "polling"] if args.mode == "both" else [args.mode]):
+        telegram.polls = 0
+        run_mode(mode, args, telegram, telegram_url, openai_url)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the OpenAI chat completions endpoint.
+
+Answers POST /v1/chat/completions (plain and stream=True) with generated text,
+after a delay modelled as
+    latency + prompt_tokens / 1000 * latency_per_1k_prompt + output_tokens * latency_per_output_token
+Tokens are approximated as 4 characters each, no tiktoken needed.
+
+With rate_limit (requests per minute) set, it's enforced the way the real API does it,
+in short windows: at most rate_limit * rate_window / 60 requests per rate_window seconds,
+the rest get a 429 with retry-after-ms. Successful responses carry x-ratelimit-* headers.
+error_rate makes a share of requests fail with a 500.
+
+Use it from a benchmark:
+    server, base_url = start_fake_openai(latency=0.3)
+    os.environ["OPENAI_BASE_URL"] = base_url     # before y_GPT is imported
+or standalone:
+    python bench/fake_openai.py --port 8081
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # Lots of connections open at once under load
+
+    def __init__(self, address, latency=0.3, latency_per_1k_prompt=0.02,
+                 latency_per_output_token=0.002, output_tokens=200,
+                 rate_limit=None, rate_window=1.0, error_rate=0.0):
+        super().__init__(address, FakeOpenAIHandler)
+        self.latency = latency
+        self.latency_per_1k_prompt = latency_per_1k_prompt
+        self.latency_per_output_token = latency_per_output_token
+        self.output_tokens = output_tokens
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.error_rate = error_rate
+        self.requests = 0
+        self.rejected = 0
+        self.errors = 0
+        self.window_start = time.monotonic()
+        self.window_requests = 0
+        self.lock = threading.Lock()
+        self.random = random.Random(42)
+
+    ## Returns (accepted, headers) for one incoming request
+    def admit(self):
+        with self.lock:
+            self.requests += 1
+            if self.rate_limit is None:
+                return True, {}
+            now = time.monotonic()
+            if now - self.window_start >= self.rate_window:
+                self.window_start, self.window_requests = now, 0
+            reset = self.rate_window - (now - self.window_start)
+            headers = {
+                "x-ratelimit-limit-requests": str(self.rate_limit),
+                "x-ratelimit-reset-requests": f"{reset * 1000:.0f}ms",
+            }
+            allowed = max(1, int(self.rate_limit * self.rate_window / 60))
+            if self.window_requests >= allowed:
+                self.rejected += 1
+                headers["x-ratelimit-remaining-requests"] = "0"
+                headers["retry-after-ms"] = f"{reset * 1000:.0f}"
+                return False, headers
+            self.window_requests += 1
+            headers["x-ratelimit-remaining-requests"] = str(allowed - self.window_requests)
+            return True, headers
+
+    def should_fail(self):
+        with self.lock:
+            if self.random.random() < self.error_rate:
+                self.errors += 1
+                return True
+            return False
+
+
+def approx_tokens(text):
+    return max(1, len(text) // 4)
+
+
+def prompt_text(messages):
+    parts = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            parts.extend(part.get("text", "") for part in content if isinstance(part, dict))
+        elif content:
+            parts.append(content)
+    return "\n".join(parts)
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # Headers and body are separate writes, don't wait for delayed ACKs
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        accepted, rate_headers = self.server.admit()
+        if not accepted:
+            self.send_json(429, {"error": {"message": "Rate limit reached for requests",
+                                           "type": "requests", "code": "rate_limit_exceeded"}}, rate_headers)
+            return
+        if self.server.should_fail():
+            self.send_json(500, {"error": {"message": "The server had an error", "type": "server_error"}})
+            return
+
+        prompt_tokens = approx_tokens(prompt_text(body.get("messages", [])))
+        output_tokens = min(self.server.output_tokens, body.get("max_tokens") or self.server.output_tokens)
+        words = [f"word{i}" for i in range(output_tokens)]
+        time.sleep(self.server.latency + prompt_tokens / 1000 * self.server.latency_per_1k_prompt)
+
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": output_tokens,
+            "total_tokens": prompt_tokens + output_tokens,
+        }
+        base = {"id": "chatcmpl-fake", "created": int(time.time()), "model": body.get("model", "fake")}
+
+        if not body.get("stream"):
+            time.sleep(output_tokens * self.server.latency_per_output_token)
+            self.send_json(200, {
+                **base,
+                "object": "chat.completion",
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": " ".join(words)},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            }, rate_headers)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        for key, value in rate_headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        for i, word in enumerate(words):
+            time.sleep(self.server.latency_per_output_token)
+            self.send_event({
+                **base,
+                "object": "chat.completion.chunk",
+                "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None}],
+            })
+        self.send_event({
+            **base,
+            "object": "chat.completion.chunk",
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        })
+        if (body.get("stream_options") or {}).get("include_usage"):
+            self.send_event({**base, "object": "chat.completion.chunk", "choices": [], "usage": usage})
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+    def send_event(self, data):
+        self.wfile.write(b"data: " + json.dumps(data).encode() + b"\n\n")
+        self.wfile.flush()
+
+    def send_json(self, status, data, headers=None):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def start_fake_openai(host="127.0.0.1", port=0, **kwargs):
+    server = FakeOpenAIServer((host, port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--latency-per-1k-prompt", type=float, default=0.02)
+    parser.add_argument("--latency-per-output-token", type=float, default=0.002)
+    parser.add_argument("--output-tokens", type=int, default=200)
+    parser.add_argument("--rate-limit", type=int, default=None, help="requests per minute")
+    parser.add_argument("--rate-window", type=float, default=1.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(
+        (args.host, args.port),
+        latency=args.latency,
+        latency_per_1k_prompt=args.latency_per_1k_prompt,
+        latency_per_output_token=args.latency_per_output_token,
+        output_tokens=args.output_tokens,
+        rate_limit=args.rate_limit,
+        rate_window=args.rate_window,
+        error_rate=args.error_rate,
+    )
+    print(f"Fake OpenAI listening on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the Telegram Bot API, enough for y_bot.py to run against.
+
+Point the bot at it with TELEGRAM_API_URL. It answers getMe, setWebhook, deleteWebhook,
+getUpdates (long polling from a queue filled by push_update), sendMessage,
+editMessageText and sendChatAction, and records every outgoing message as
+(time, method, chat_id, message_id, text) in server.sent, calling server.on_sent
+with it if set. getFile and file downloads serve whatever add_file put in server.files.
+
+Use it from a benchmark:
+    server, api_url = start_fake_telegram()
+    server.push_update(make_text_update(update_id, chat_id, "hello"))   # polling mode
+"""
+
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+
+def make_text_update(update_id, chat_id, text, username="bench"):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": username, "username": username},
+            "text": text,
+        },
+    }
+
+
+## sizes - [(file_id, width, height)], smallest first, like Telegram sends them
+def make_photo_update(update_id, chat_id, sizes, caption=None, username="bench"):
+    update = make_text_update(update_id, chat_id, None, username)
+    del update["message"]["text"]
+    update["message"]["photo"] = [
+        {"file_id": file_id, "file_unique_id": f"u_{file_id}", "width": width, "height": height}
+        for file_id, width, height in sizes
+    ]
+    if caption:
+        update["message"]["caption"] = caption
+    return update
+
+
+class FakeTelegramServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # Lots of connections open at once under load
+
+    def __init__(self, address):
+        super().__init__(address, FakeTelegramHandler)
+        self.updates = []
+        self.sent = []
+        self.webhook_url = None
+        self.polls = 0
+        self.files = {}
+        self.on_sent = None
+        self.message_ids = itertools.count(1000)
+        self.condition = threading.Condition()
+
+    def handle_error(self, request, client_address):
+        pass  # The bot going away in the middle of a long poll
+
+    def push_update(self, update):
+        with self.condition:
+            self.updates.append(update)
+            self.condition.notify_all()
+
+    ## Like the real getUpdates: returns at once if there's something newer than offset,
+    ## otherwise waits up to timeout seconds for it
+    def get_updates(self, offset, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                pending = [update for update in self.updates if update["update_id"] >= offset]
+                remaining = deadline - time.monotonic()
+                if pending or remaining <= 0:
+                    self.updates = pending
+                    return pending
+                self.condition.wait(remaining)
+
+    def add_file(self, file_id, content):
+        self.files[file_id] = content
+
+    def record(self, method, chat_id, message_id, text):
+        sent = (time.perf_counter(), method, int(chat_id), message_id, text)
+        with self.condition:
+            self.sent.append(sent)
+            self.condition.notify_all()
+        if self.on_sent:
+            self.on_sent(sent)
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # Headers and body are separate writes, don't wait for delayed ACKs
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if self.path.startswith("/file/"):
+            self.send_file(self.path.rsplit("/", 1)[-1])
+            return
+        method = self.path.rstrip("/").rsplit("/", 1)[-1]
+        raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            params = json.loads(raw or b"{}")
+        else:
+            params = {key: values[0] for key, values in parse_qs(raw.decode()).items()}
+
+        server = self.server
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "setWebhook":
+            server.webhook_url = params.get("url")
+            result = True
+        elif method == "deleteWebhook":
+            server.webhook_url = None
+            result = True
+        elif method == "getUpdates":
+            server.polls += 1
+            result = server.get_updates(int(params.get("offset") or 0), float(params.get("timeout") or 0))
+        elif method in ("sendMessage", "editMessageText"):
+            message_id = int(params.get("message_id") or next(server.message_ids))
+            server.record(method, params["chat_id"], message_id, params.get("text", ""))
+            result = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(params["chat_id"]), "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        elif method == "sendChatAction":
+            result = True
+        elif method == "getFile" and params.get("file_id") in server.files:
+            file_id = params["file_id"]
+            result = {
+                "file_id": file_id,
+                "file_unique_id": f"u_{file_id}",
+                "file_size": len(server.files[file_id]),
+                "file_path": f"photos/{file_id}",
+            }
+        else:
+            self.send_json(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+            return
+        self.send_json(200, {"ok": True, "result": result})
+
+    do_GET = do_POST
+
+    def send_file(self, file_id):
+        content = self.server.files.get(file_id)
+        if content is None:
+            self.send_json(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_json(self, status, data):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def start_fake_telegram(host="127.0.0.1", port=0):
+    server = FakeTelegramServer((host, port))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
@@ -36,10 +36,29 @@ BOT_TOKEN=$BOT_TOKEN
 OPENAI_API_KEY=$OPENAI_API_KEY
 EOF
 
+# Optional webhook mode: export WEBHOOK_URL (and WEBHOOK_PORT, WEBHOOK_SECRET) before running this
+# Optional multi-process mode: export WORKERS
+# Optional metrics endpoint: export METRICS_PORT (published on the host's localhost only)
+# Optional slow message logging: export SLOW_UPDATE_SECONDS
+for var in WEBHOOK_URL WEBHOOK_PORT WEBHOOK_SECRET WORKERS METRICS_PORT SLOW_UPDATE_SECONDS; do
+  if [ -n "${!var}" ]; then
+    echo "$var=${!var}" >> ./app/y_secrets.env
+  fi
+done
+if [ -n "$WEBHOOK_URL" ]; then
+  publish="-p ${WEBHOOK_PORT:-8443}:${WEBHOOK_PORT:-8443}"
+fi
+if [ -n "$METRICS_PORT" ]; then
+  echo "METRICS_HOST=0.0.0.0" >> ./app/y_secrets.env
+  # One port per worker, METRICS_PORT + n
+  last_metrics_port=$((METRICS_PORT + ${WORKERS:-1} - 1))
+  publish="$publish -p 127.0.0.1:$METRICS_PORT-$last_metrics_port:$METRICS_PORT-$last_metrics_port"
+fi
+
 echo "THIS IS ./app/y_sercrets.env"
 cat ./app/y_secrets.env
 
-docker build -t $container_name . && docker run -d --name $container_name $container_name
+docker build -t $container_name . && docker run -d $publish --stop-timeout 45 --name $container_name $container_name
 
 if [ $? -eq 0 ]; then
   echo "$container_name container is now running."
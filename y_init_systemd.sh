@@ -69,6 +69,16 @@ BOT_TOKEN=$BOT_TOKEN
 OPENAI_API_KEY=$OPENAI_API_KEY
 EOF
 
+# Optional webhook mode: export WEBHOOK_URL (and WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_SECRET) before running this
+# Optional multi-process mode: export WORKERS
+# Optional metrics endpoint: export METRICS_PORT (and METRICS_HOST)
+# Optional slow message logging: export SLOW_UPDATE_SECONDS
+for var in WEBHOOK_URL WEBHOOK_LISTEN WEBHOOK_PORT WEBHOOK_SECRET WORKERS METRICS_HOST METRICS_PORT SLOW_UPDATE_SECONDS; do
+  if [ -n "${!var}" ]; then
+    echo "$var=${!var}" >> $SECRETS_FILE
+  fi
+done
+
 # Create virtual environment and install dependencies
 
 python3 -m venv $VENV_DIR
@@ -90,6 +100,9 @@ WorkingDirectory=$APP_DIR
 EnvironmentFile=$SECRETS_FILE
 ExecStart=$VENV_DIR/bin/python $APP_DIR/y_bot.py
 Restart=on-failure
+# SIGTERM only to the main process, it stops the worker processes itself
+KillMode=mixed
+TimeoutStopSec=45
 
 [Install]
 WantedBy=multi-user.target